@@ -0,0 +1,49 @@
+import os
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Process settings, parsed once at import
+LOG_LEVEL       = os.getenv("LOG_LEVEL", "INFO").upper()
+PORT            = int(os.getenv("PORT", 8000))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))  # tokens are shared via SQLite; pending friend state is per process
+
+# Set up logging; records are queued and written to stderr by a listener thread
+log_queue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+log_listener = QueueListener(log_queue, _stream_handler)
+_queue_handler = QueueHandler(log_queue)
+# Only merge args into the message here; the listener's handler applies the real format
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=LOG_LEVEL, handlers=[_queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
+# httpx logs every request URL at INFO, and Telegram URLs carry the bot token
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+
+# ====== Environment Variables ======
+# Please set these in your Render/hosting environment
+TELEGRAM_BOT_TOKEN    = os.getenv("TELEGRAM_BOT_TOKEN")    # e.g. '123456:ABC-DEF...'
+SPLITWISE_CLIENT_ID    = os.getenv("SPLITWISE_CLIENT_ID")    # your Splitwise OAuth2 client id
+SPLITWISE_CLIENT_SECRET = os.getenv("SPLITWISE_CLIENT_SECRET")  # your Splitwise OAuth2 client secret
+OPENAI_API_KEY            = os.getenv("OPENAI_API_KEY")            # your OpenAI API key
+CALLBACK_BASE_URL         = os.getenv("CALLBACK_BASE_URL")         # e.g. 'https://your-domain.com/auth/splitwise/callback'
+SUPERMEMORY_API_KEY       = os.getenv("SUPERMEMORY_API_KEY")       # your supermemory API key
+TELEGRAM_WEBHOOK_SECRET   = os.getenv("TELEGRAM_WEBHOOK_SECRET")   # optional; sent by Telegram as X-Telegram-Bot-Api-Secret-Token
+
+# Validate critical env vars
+for var_name in ["TELEGRAM_BOT_TOKEN", "SPLITWISE_CLIENT_ID", "SPLITWISE_CLIENT_SECRET", "OPENAI_API_KEY", "CALLBACK_BASE_URL"]:
+    if not globals().get(var_name):
+        logging.error("Missing required environment variable: %s", var_name)
+        # If missing, the service will still start, but endpoints depending on it will fail.
+
+# Storage files
+tokens_db = "tokens.db"
+tokens_file = "user_tokens.json"  # legacy JSON store, imported into tokens_db on first start
@@ -1,71 +1,117 @@
-from fastapi import FastAPI, Request, APIRouter, HTTPException, Query
+from fastapi import FastAPI, Request, APIRouter, HTTPException, Query, BackgroundTasks
 from pydantic import BaseModel
-from dotenv import load_dotenv
 import os
 import httpx
 import openai
 import logging
-import json
 from urllib.parse import urlencode
-import traceback
 import re
 import asyncio
 from typing import Optional
+from contextlib import asynccontextmanager
 from supermemory import Supermemory
+from cachetools import LRUCache, TTLCache
 import datetime
-from fastapi.responses import JSONResponse
-
-# Load environment variables
-load_dotenv()
+import time
+import hashlib
+import functools
+import weakref
+import hmac
+import sqlite3
+import bisect
+import orjson
+import msgspec
+from fastapi.responses import JSONResponse, Response
+from fastapi.middleware.gzip import GZipMiddleware
+
+from app.config import (
+    TELEGRAM_BOT_TOKEN,
+    SPLITWISE_CLIENT_ID,
+    SPLITWISE_CLIENT_SECRET,
+    OPENAI_API_KEY,
+    CALLBACK_BASE_URL,
+    SUPERMEMORY_API_KEY,
+    TELEGRAM_WEBHOOK_SECRET,
+    PORT,
+    WEB_CONCURRENCY,
+    tokens_db,
+    tokens_file,
+)
 
-# Set up logging
 tlogging = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)s] %(message)s')
-
-# ====== Environment Variables ======
-# Please set these in your Render/hosting environment
-TELEGRAM_BOT_TOKEN    = os.getenv("TELEGRAM_BOT_TOKEN")    # e.g. '123456:ABC-DEF...'
-SPLITWISE_CLIENT_ID    = os.getenv("SPLITWISE_CLIENT_ID")    # your Splitwise OAuth2 client id
-SPLITWISE_CLIENT_SECRET = os.getenv("SPLITWISE_CLIENT_SECRET")  # your Splitwise OAuth2 client secret
-OPENAI_API_KEY            = os.getenv("OPENAI_API_KEY")            # your OpenAI API key
-CALLBACK_BASE_URL         = os.getenv("CALLBACK_BASE_URL")         # e.g. 'https://your-domain.com/auth/splitwise/callback'
-
-# Validate critical env vars
-for var_name in ["TELEGRAM_BOT_TOKEN", "SPLITWISE_CLIENT_ID", "SPLITWISE_CLIENT_SECRET", "OPENAI_API_KEY", "CALLBACK_BASE_URL"]:
-    if not globals().get(var_name):
-        logging.error(f"Missing required environment variable: {var_name}")
-        # If missing, the service will still start, but endpoints depending on it will fail.
 
 # Configure OpenAI key
 openai.api_key = OPENAI_API_KEY
 
-# Storage files
-tokens_file = "user_tokens.json"
+# Fail fast on connect and on waiting for a pooled connection; allow slower reads/writes
+HTTP_TIMEOUT = httpx.Timeout(connect=5.0, read=30.0, write=30.0, pool=10.0)
+
+# Shared HTTP clients, one pool per upstream so a burst of Telegram sends
+# cannot starve Splitwise calls of connections (or the reverse). Idle connections
+# are kept for 30s instead of httpx's 5s so bursty traffic skips new TLS handshakes
+splitwise_client = httpx.AsyncClient(
+    base_url="https://secure.splitwise.com",
+    timeout=HTTP_TIMEOUT,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=10, keepalive_expiry=30),
+    http2=True
+)
+telegram_client = httpx.AsyncClient(
+    base_url=f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}",
+    timeout=HTTP_TIMEOUT,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30),
+    http2=True
+)
 
-# Ensure storage exists
-if not os.path.exists(tokens_file):
-    with open(tokens_file, 'w') as f:
-        json.dump({}, f)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Shutdown: release pooled connections
+    await splitwise_client.aclose()
+    await telegram_client.aclose()
+    if openai_client is not None:
+        await openai_client.close()
 
 # Initialize FastAPI
 app = FastAPI(
     title="Splitwise Telegram Connector",
     description="FastAPI app to connect Telegram bot with Splitwise, with OAuth and expense parsing.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
+# Compress larger JSON bodies (parsed expenses, search results); tiny acks stay uncompressed
+app.add_middleware(GZipMiddleware, minimum_size=512)
 router = APIRouter()
 
 # Add at the top with other global variables
 pending_expenses = {}
 # In-memory context for pending new friend creation
 pending_new_friend = {}
-
-# After load_dotenv()
-supermemory_client = Supermemory(api_key=os.environ.get("SUPERMEMORY_API_KEY"))
+# Friend lists change rarely; cache them per access token for 10 minutes
+friends_cache = TTLCache(maxsize=10_000, ttl=600)
+# (friends list, FriendNameIndex) per access token, rebuilt when the cached list changes
+friend_index_cache = TTLCache(maxsize=10_000, ttl=600)
+# Splitwise categories are global and near-static; one flattened list and its name index for a day
+categories_cache = TTLCache(maxsize=1, ttl=24 * 60 * 60)
+# Splitwise user behind each access token
+current_user_cache = LRUCache(maxsize=4096)
+# Id of the last expense created through the bot per chat, for "delete last expense"
+last_expense_ids = LRUCache(maxsize=10_000)
+# Raw model output for previously parsed messages, keyed by parse_cache_key()
+parse_cache = TTLCache(maxsize=2048, ttl=24 * 60 * 60)
+# Recent history-search results per chat, dropped whenever the chat stores a new memory
+search_cache = TTLCache(maxsize=10_000, ttl=600)
+# (friends list, rendered prompt context) per user, see expense_prompt_context()
+prompt_context_cache = LRUCache(maxsize=4096)
+
+supermemory_client = Supermemory(api_key=SUPERMEMORY_API_KEY)
+
+# Static probe bodies, encoded once; async handlers also skip the threadpool hop
+HEALTH_RESPONSE = Response(content=b'{"status":"ok"}', media_type="application/json")
+ROOT_RESPONSE = Response(content=b'{"status":"running"}', media_type="application/json")
 
 @app.get("/health")
-def health():
-    return {"status": "ok"}
+async def health():
+    return HEALTH_RESPONSE
 
 # ----------- Models -----------
 class ExpenseInput(BaseModel):
@@ -80,150 +126,356 @@ class ParseInput(BaseModel):
 class WebhookInput(BaseModel):
     url: str
 
+# Telegram updates are decoded with msgspec into just the fields the bot reads;
+# everything else in the update is skipped without building Python objects.
+class TelegramChat(msgspec.Struct):
+    id: int | str
+
+class TelegramMessage(msgspec.Struct):
+    chat: TelegramChat
+    text: str = ""
+
+class TelegramUpdate(msgspec.Struct):
+    message: TelegramMessage | None = None
+    edited_message: TelegramMessage | None = None
+
 # ----------- Storage Helpers -----------
 def load_json(fname):
-    with open(fname, 'r') as f:
-        return json.load(f)
+    with open(fname, 'rb') as f:
+        return orjson.loads(f.read())
 
-def save_json(fname, data):
-    with open(fname, 'w') as f:
-        json.dump(data, f)
+UPSERT_TOKEN_SQL = (
+    "INSERT INTO tokens (chat_id, access_token, splitwise_id, splitwise_name) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(chat_id) DO UPDATE SET access_token = excluded.access_token, "
+    "splitwise_id = excluded.splitwise_id, splitwise_name = excluded.splitwise_name"
+)
+
+def open_tokens_db(fname):
+    # Autocommit + WAL: each upsert is one atomic row write instead of a full file rewrite.
+    # Reads (warm load, cache-miss lookups) run on the event loop thread; upserts run in
+    # asyncio.to_thread workers, hence check_same_thread=False. tokens_write_lock keeps
+    # those workers to one writer at a time, so the shared connection is never used
+    # by two writers at once and upserts land in the order they were made.
+    conn = sqlite3.connect(fname, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tokens ("
+        "chat_id TEXT PRIMARY KEY, access_token TEXT NOT NULL, "
+        "splitwise_id INTEGER, splitwise_name TEXT)"
+    )
+    # One-time import of the legacy JSON store
+    empty = conn.execute("SELECT 1 FROM tokens LIMIT 1").fetchone() is None
+    if empty and os.path.exists(tokens_file):
+        legacy = load_json(tokens_file)
+        conn.executemany(UPSERT_TOKEN_SQL, [
+            (chat_id, t["access_token"], t.get("splitwise_id"), t.get("splitwise_name"))
+            for chat_id, t in legacy.items()
+        ])
+        logging.info("Imported %s tokens from %s into %s", len(legacy), tokens_file, fname)
+    return conn
+
+def load_user_tokens(conn) -> dict:
+    rows = conn.execute("SELECT chat_id, access_token, splitwise_id, splitwise_name FROM tokens")
+    return {
+        chat_id: {"access_token": access_token, "splitwise_id": splitwise_id, "splitwise_name": splitwise_name}
+        for chat_id, access_token, splitwise_id, splitwise_name in rows
+    }
+
+tokens_conn = open_tokens_db(tokens_db)
+# Cache-aside over SQLite: warmed at startup, misses fall through to the table (another
+# worker may have saved the token since), writes go to the cache and then through to SQLite
+user_tokens = load_user_tokens(tokens_conn)
+
+# Serializes writers so upserts reach SQLite in the order they were made
+tokens_write_lock = asyncio.Lock()
 
 def get_user_token(chat_id: str) -> dict | None:
-    tokens = load_json(tokens_file)
-    return tokens.get(chat_id)
+    token = user_tokens.get(chat_id)
+    if token is None:
+        row = tokens_conn.execute(
+            "SELECT access_token, splitwise_id, splitwise_name FROM tokens WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        if row is not None:
+            access_token, splitwise_id, splitwise_name = row
+            token = user_tokens[chat_id] = {
+                "access_token": access_token,
+                "splitwise_id": splitwise_id,
+                "splitwise_name": splitwise_name
+            }
+    return token
 
-def set_user_token(chat_id: str, access_token: str, splitwise_id: int, splitwise_name: str):
-    tokens = load_json(tokens_file)
-    tokens[chat_id] = {
+async def set_user_token(chat_id: str, access_token: str, splitwise_id: int, splitwise_name: str):
+    user_tokens[chat_id] = {
         "access_token": access_token,
         "splitwise_id": splitwise_id,
         "splitwise_name": splitwise_name
     }
-    save_json(tokens_file, tokens)
-    print(f"Saved token for {chat_id}: {tokens[chat_id]}")
+    # The disk write runs in a worker thread so it never stalls the event loop
+    async with tokens_write_lock:
+        await asyncio.to_thread(tokens_conn.execute, UPSERT_TOKEN_SQL, (chat_id, access_token, splitwise_id, splitwise_name))
+    logging.info("Saved token for %s (splitwise id %s)", chat_id, splitwise_id)
+
+# ----------- Splitwise Auth Headers -----------
+@functools.lru_cache(maxsize=4096)
+def auth_headers(access_token: str) -> dict:
+    # Keyed by token, so a re-authorised chat simply gets a new entry; callers must not mutate it
+    return {"Authorization": f"Bearer {access_token}"}
 
 # ----------- Splitwise User Info Helper -----------
 async def get_splitwise_current_user(token: str):
-    url = "https://secure.splitwise.com/api/v3.0/get_current_user"
-    headers = {"Authorization": f"Bearer {token}"}
-    async with httpx.AsyncClient() as client:
-        res = await client.get(url, headers=headers)
-        res.raise_for_status()
-        return res.json()["user"]
+    # A token always belongs to the same Splitwise user, so the answer never goes stale
+    if token in current_user_cache:
+        return current_user_cache[token]
+    url = "/api/v3.0/get_current_user"
+    headers = auth_headers(token)
+    res = await splitwise_client.get(url, headers=headers)
+    res.raise_for_status()
+    user = orjson.loads(res.content)["user"]
+    current_user_cache[token] = user
+    return user
 
 # ----------- Splitwise OAuth 2.0 Flow -----------
+# Everything but the per-user state is fixed, so encode it once
+OAUTH_AUTHORIZE_PREFIX = "https://secure.splitwise.com/oauth/authorize?" + urlencode({
+    "client_id": SPLITWISE_CLIENT_ID,
+    "response_type": "code",
+    "redirect_uri": f"{CALLBACK_BASE_URL}",
+    "scope": "",  # Splitwise does not use scopes, but keep for spec compliance
+})
+OAUTH_TOKEN_FORM = {
+    "grant_type": "authorization_code",
+    "client_id": SPLITWISE_CLIENT_ID,
+    "client_secret": SPLITWISE_CLIENT_SECRET,
+    "redirect_uri": f"{CALLBACK_BASE_URL}",
+}
+
+def build_authorize_url(chat_id) -> str:
+    return f"{OAUTH_AUTHORIZE_PREFIX}&{urlencode({'state': str(chat_id)})}"
+
 @router.get("/auth/splitwise/start")
 async def start_oauth(chat_id: int):
-    params = {
-        "client_id": SPLITWISE_CLIENT_ID,
-        "response_type": "code",
-        "redirect_uri": f"{CALLBACK_BASE_URL}",
-        "scope": "",  # Splitwise does not use scopes, but keep for spec compliance
-        "state": str(chat_id)
-    }
-    auth_url = f"https://secure.splitwise.com/oauth/authorize?{urlencode(params)}"
-    return {"auth_url": auth_url}
+    return {"auth_url": build_authorize_url(chat_id)}
+
+# Per-chat locks serialise concurrent callbacks; entries vanish once no callback holds them
+oauth_locks = weakref.WeakValueDictionary()
+# Authorization codes already exchanged, so a repeated redirect is answered without a second POST
+consumed_oauth_codes = TTLCache(maxsize=1024, ttl=600)
+
+def oauth_lock(chat_id: str) -> asyncio.Lock:
+    lock = oauth_locks.get(chat_id)
+    if lock is None:
+        lock = oauth_locks[chat_id] = asyncio.Lock()
+    return lock
 
 @router.get("/auth/splitwise/callback")
 async def callback_oauth(code: str, state: str):
     chat_id = state  # Use state as chat_id
-    token_url = "https://secure.splitwise.com/oauth/token"
-    data = {
-        "grant_type": "authorization_code",
-        "client_id": SPLITWISE_CLIENT_ID,
-        "client_secret": SPLITWISE_CLIENT_SECRET,
-        "redirect_uri": f"{CALLBACK_BASE_URL}",
-        "code": code,
-    }
-    async with httpx.AsyncClient() as client:
-        res = await client.post(token_url, data=data)
+    # A double-submitted redirect waits for the first exchange instead of replaying a spent code
+    async with oauth_lock(chat_id):
+        if consumed_oauth_codes.get(code) == chat_id:
+            return {"status": "authorized"}
+        token_url = "/oauth/token"
+        data = {**OAUTH_TOKEN_FORM, "code": code}
+        res = await splitwise_client.post(token_url, data=data)
         if res.status_code != 200:
-            logging.error(f"Splitwise token error: {res.text} | Sent data: {data}")
+            safe = {**data, "client_secret": "***", "code": "***"}
+            logging.error("Splitwise token error: %s | Sent data: %s", res.text, safe)
             raise HTTPException(status_code=502, detail=f"Splitwise token error: {res.text}")
         try:
-            token_data = res.json()
+            token_data = orjson.loads(res.content)
         except Exception as e:
-            logging.error(f"Could not parse Splitwise token response as JSON: {res.text}")
+            logging.error("Could not parse Splitwise token response as JSON: %s", res.text)
             raise HTTPException(status_code=502, detail="Splitwise token response not JSON")
-    if "access_token" not in token_data:
-        logging.error(f"Splitwise token response missing access_token: {token_data}")
-        raise HTTPException(status_code=502, detail="Splitwise token response missing access_token")
-    # Fetch Splitwise user info
-    user_info = await get_splitwise_current_user(token_data["access_token"])
-    splitwise_id = user_info["id"]
-    splitwise_name = user_info.get("first_name", "Me")
-    set_user_token(str(chat_id), token_data["access_token"], splitwise_id, splitwise_name)
+        if "access_token" not in token_data:
+            logging.error("Splitwise token response missing access_token (keys: %s)", list(token_data))
+            raise HTTPException(status_code=502, detail="Splitwise token response missing access_token")
+        # Fetch Splitwise user info and warm the friends and categories caches together, so the first
+        # expense or category command skips those round-trips; only the user lookup is required to succeed
+        user_info, _, _ = await asyncio.gather(
+            get_splitwise_current_user(token_data["access_token"]),
+            get_splitwise_friends(token_data["access_token"]),
+            get_splitwise_categories(token_data["access_token"]),
+            return_exceptions=True
+        )
+        if isinstance(user_info, BaseException):
+            raise user_info
+        splitwise_id = user_info["id"]
+        splitwise_name = user_info.get("first_name", "Me")
+        await set_user_token(str(chat_id), token_data["access_token"], splitwise_id, splitwise_name)
+        consumed_oauth_codes[code] = chat_id
     await send_telegram_message(chat_id, "✅ Splitwise account authorized! You can now add expenses.")
     return {"status": "authorized"}
 
 # ----------- Services -----------
+openai_client = None
+
+def get_openai_client() -> openai.AsyncOpenAI:
+    # Created lazily so the app still starts when OPENAI_API_KEY is missing
+    global openai_client
+    if openai_client is None:
+        openai_client = openai.AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            # The SDK's default client keeps its own defaults (redirects etc.); only pooling and timeouts change
+            http_client=openai.DefaultAsyncHttpxClient(
+                timeout=HTTP_TIMEOUT,
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=30),
+                http2=True
+            )
+        )
+    return openai_client
+
+# Static instructions, output schema and rules shared by every expense parse
+EXPENSE_SYSTEM_MESSAGE = (
+    "You are an expert expense‑splitting assistant. "
+    "Users will send you quick, messy notes about group expenses. "
+    "Your task is to identify every item, its cost, who had it (or if it was shared), "
+    "any percentage discounts (and which items are excluded), "
+    "and if a final total is given, adjust shares proportionally so they sum exactly. "
+    "If an item is not marked as shared, assign it only to the person(s) mentioned. "
+    "If a participant is not mentioned for an item, assume it is shared by all unless context suggests otherwise. "
+    "If currency is not specified, default to INR. "
+    "Return only a raw JSON object—no markdown, no commentary.\n\n"
+    "Extract the user's input into structured JSON with:\n"
+    "- amount: total bill (number)\n"
+    "- currency: currency code (e.g. INR)\n"
+    "- payer: who paid\n"
+    "- participants: [{ name: ..., share: ... }, …]\n"
+    "- description: short summary (max 4 words)\n\n"
+    "Rules:\n"
+    "1. Find every item and its cost. If an item is shared, split it equally or as specified.\n"
+    "2. If an item is not marked as shared, assign it only to the person(s) mentioned.\n"
+    "3. If a participant is not mentioned for an item, assume it is shared by all unless context suggests otherwise.\n"
+    "4. Detect any % discount and apply only to eligible items; exclude items explicitly noted (e.g. soft drinks).\n"
+    "5. If the user states a final total different from the computed sum (due to rounding/tax), distribute the difference proportionally.\n"
+    "6. If currency is not specified, default to INR.\n"
+    "7. Ensure shares sum exactly to total bill.\n"
+    "⚠️ Output ONLY a valid, minified JSON object on one line. No markdown, no whitespace, no extra text.\n"
+    "⚠️ Ensure all amounts are numbers, not strings."
+)
+
+# Only per-user context goes in the user turn, after the static system prefix,
+# so the provider can reuse the cached prefix; values are filled in with str.format_map
+EXPENSE_CONTEXT_TEMPLATE = (
+    "You are the user {self_name} (id {self_user_id}). "
+    "Your friends are: {friends}. "
+    "Whenever text refers to me (me, mine, {self_name}, {telegram_name}), map it to {self_name} (id {self_user_id}). "
+)
+
+def expense_prompt_context(friends: list, self_name: str, self_user_id: int, telegram_name: str = None) -> str:
+    # Rendered once per user and reused until the cached friends list is replaced
+    key = (self_user_id, self_name, telegram_name)
+    entry = prompt_context_cache.get(key)
+    if entry is None or entry[0] is not friends:
+        context = EXPENSE_CONTEXT_TEMPLATE.format_map({
+            "self_name": self_name,
+            "self_user_id": self_user_id,
+            "friends": ", ".join([f"{f['first_name']} (id: {f['id']})" for f in friends]),
+            "telegram_name": telegram_name or ""
+        })
+        entry = (friends, context)
+        prompt_context_cache[key] = entry
+    return entry[1]
+
+# Upper bound on the parse output; minified JSON for a busy group bill stays well below this
+PARSE_MAX_TOKENS = 600
+
+def parse_cache_key(text: str, friends: list, self_user_id: int) -> str:
+    # Case and spacing never change the parse, so "Dinner  500 w/ Rahul" and "dinner 500 w/ rahul" share an entry
+    normalized = " ".join(text.split()).casefold()
+    friend_ids = ",".join(sorted(str(f["id"]) for f in friends))
+    return hashlib.blake2b(f"{normalized}|{friend_ids}|{self_user_id}".encode(), digest_size=16).hexdigest()
+
+# Local fast path for the plain "paid 900 for dinner with A and B" shape. It only
+# accepts single-word names and short descriptions; anything richer goes to the model
+FAST_EXPENSE_RE = re.compile(
+    r"^(?:i\s+)?(?:paid|spent)\s+(?P<amount>\d+(?:\.\d{1,2})?)\s+(?:for|on)\s+"
+    r"(?P<description>\w+(?:\s+\w+){0,3}?)\s+(?:with|between)\s+(?P<others>[a-z][a-z ,]*)$",
+    re.I
+)
+FAST_NAME_SPLIT_RE = re.compile(r"\s*,\s*(?:and\s+)?|\s+and\s+", re.I)
+FAST_NAME_RE = re.compile(r"[a-z]+", re.I)
+FAST_PATH_GROUP_WORDS = frozenset({"all", "everyone", "everybody", "us", "them", "others", "friends", "equally", "each", "split"})
+# Pronouns that name the user or someone relative to them; the model resolves these
+FAST_PATH_PRONOUNS = frozenset({"me", "mine", "self", "i", "my", "myself", "you", "yourself", "him", "himself", "her", "herself", "themselves", "ourselves"})
+
+def parse_expense_fast_path(text: str, self_name: str = None, telegram_name: str = None) -> dict | None:
+    """Parse a simple equal split paid by the user without calling the model; None means no match"""
+    match = FAST_EXPENSE_RE.match(text.strip())
+    if not match:
+        return None
+    names = FAST_NAME_SPLIT_RE.split(match["others"].strip())
+    if not all(FAST_NAME_RE.fullmatch(name) for name in names):
+        return None
+    # Any word of the user's own names would add the user twice
+    own_names = set(f"{self_name or ''} {telegram_name or ''}".casefold().split())
+    lowered = [name.casefold() for name in names]
+    if len(set(lowered)) != len(lowered) or any(
+        name in FAST_PATH_GROUP_WORDS or name in FAST_PATH_PRONOUNS or name in own_names for name in lowered
+    ):
+        return None
+    participants = ["me", *names]
+    amount = float(match["amount"])
+    if amount.is_integer():
+        amount = int(amount)
+    share = round(amount / len(participants), 2)
+    # The last participant absorbs the rounding remainder so shares sum to the amount
+    shares = [share] * (len(participants) - 1) + [round(amount - share * (len(participants) - 1), 2)]
+    return {
+        "amount": amount,
+        "currency": "INR",
+        "payer": "me",
+        "participants": [{"name": name, "share": s} for name, s in zip(participants, shares)],
+        "description": match["description"]
+    }
+
 async def parse_expense_from_text(text: str, friends: list, self_name: str, self_user_id: int, telegram_name: str = None) -> dict:
-    friend_list_str = ", ".join([f"{f['first_name']} (id: {f['id']})" for f in friends])
-    self_refs = [self_name, "me", "mine", "self", "I"]
-    if telegram_name and telegram_name != self_name:
-        self_refs.append(telegram_name)
-    self_refs_str = ", ".join(self_refs)
-    system_message = (
-        "You are an expert expense‑splitting assistant. "
-        "Users will send you quick, messy notes about group expenses. "
-        "Your task is to identify every item, its cost, who had it (or if it was shared), "
-        "any percentage discounts (and which items are excluded), "
-        "and if a final total is given, adjust shares proportionally so they sum exactly. "
-        "If an item is not marked as shared, assign it only to the person(s) mentioned. "
-        "If a participant is not mentioned for an item, assume it is shared by all unless context suggests otherwise. "
-        "If currency is not specified, default to INR. "
-        "Return only a raw JSON object—no markdown, no commentary."
-    )
-    user_message = (
-        f"You are the user {self_name} (id {self_user_id}). "
-        f"Your friends are: {friend_list_str}. "
-        f"Whenever text refers to me (me, mine, {self_name}, {telegram_name or ''}), map it to {self_name} (id {self_user_id}). "
-        f"The user's input was:\n\"{text}\"\n\n"
-        "Extract and convert it into structured JSON with:\n"
-        "- amount: total bill (number)\n"
-        "- currency: currency code (e.g. INR)\n"
-        "- payer: who paid\n"
-        "- participants: [{ name: ..., share: ... }, …]\n"
-        "- description: short summary (max 4 words)\n\n"
-        "Rules:\n"
-        "1. Find every item and its cost. If an item is shared, split it equally or as specified.\n"
-        "2. If an item is not marked as shared, assign it only to the person(s) mentioned.\n"
-        "3. If a participant is not mentioned for an item, assume it is shared by all unless context suggests otherwise.\n"
-        "4. Detect any % discount and apply only to eligible items; exclude items explicitly noted (e.g. soft drinks).\n"
-        "5. If the user states a final total different from the computed sum (due to rounding/tax), distribute the difference proportionally.\n"
-        "6. If currency is not specified, default to INR.\n"
-        "7. Ensure shares sum exactly to total bill.\n"
-        "⚠️ Output ONLY a valid JSON object. No markdown, no extra text.\n"
-        "⚠️ Ensure all amounts are numbers, not strings."
-    )
+    parsed = parse_expense_fast_path(text, self_name, telegram_name)
+    if parsed is not None:
+        logging.debug("Parsed expense locally: %s", parsed)
+        return parsed
+    cache_key = parse_cache_key(text, friends, self_user_id)
+    cached = parse_cache.get(cache_key)
+    if cached is not None:
+        # Decode again so callers can mutate the result without touching the cache
+        return orjson.loads(cached)
+    context = expense_prompt_context(friends, self_name, self_user_id, telegram_name)
+    user_message = f"{context}The user's input was:\n\"{text}\""
     try:
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        response = client.chat.completions.create(
+        response = await get_openai_client().chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": system_message},
+                {"role": "system", "content": EXPENSE_SYSTEM_MESSAGE},
                 {"role": "user", "content": user_message}
-            ]
+            ],
+            response_format={"type": "json_object"},
+            max_tokens=PARSE_MAX_TOKENS
         )
         content = response.choices[0].message.content
-        logging.debug(f"OpenAI response content: {content}")
-        content = re.sub(r"^```json\\s*|^```\\s*|```$", "", content.strip(), flags=re.MULTILINE).strip()
-        parsed = json.loads(content)
+        logging.debug("OpenAI response content: %s", content)
+        parsed = orjson.loads(content)
+        parse_cache[cache_key] = content
         return parsed
-    except json.JSONDecodeError as e:
-        logging.error(f"OpenAI returned invalid JSON: {content}")
+    except orjson.JSONDecodeError as e:
+        logging.error("OpenAI returned invalid JSON: %s", content)
         raise HTTPException(status_code=500, detail=f"Parsing failed: Invalid JSON returned by model: {content}")
     except Exception as e:
-        logging.error(f"OpenAI parsing error: {e}\n{traceback.format_exc()}")
+        logging.error("OpenAI parsing error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Parsing failed: {str(e)}")
 
-async def create_splitwise_expense(chat_id: str, expense: dict):
-    token = get_user_token(chat_id)
+@functools.lru_cache(maxsize=None)
+def user_field_keys(i: int) -> tuple[str, str, str]:
+    """Splitwise form field names for the i-th user, built once per index"""
+    return (f"users__{i}__user_id", f"users__{i}__paid_share", f"users__{i}__owed_share")
+
+async def create_splitwise_expense(chat_id: str, expense: dict, token: dict | None = None):
+    # Callers that already hold the user's token pass it in to skip the lookup
+    if token is None:
+        token = get_user_token(chat_id)
     if not token:
         raise HTTPException(status_code=401, detail="User not authorized with Splitwise")
-    url = "https://secure.splitwise.com/api/v3.0/create_expense"
-    headers = {"Authorization": f"Bearer {token['access_token']}"}
+    url = "/api/v3.0/create_expense"
+    headers = auth_headers(token["access_token"])
 
     # Build payload
     data = {
@@ -232,66 +484,172 @@ async def create_splitwise_expense(chat_id: str, expense: dict):
         "currency_code": expense.get("currency_code", "INR")
     }
 
-    # --- Fix: Ensure shares sum exactly to total cost ---
-    shares = expense.get("shares", {})
+    # Owed share per participant, converted once; missing shares fall back to an equal split
+    shares = expense.get("shares") or {}
     owed_by = expense["owed_by"]
     cost = float(expense["cost"])
-    share_sum = sum(float(shares.get(str(uid), 0)) for uid in owed_by)
-    diff = round(cost - share_sum, 2)
-    if abs(diff) > 0.01 and owed_by:
-        # Adjust the last participant's share
-        last_uid = owed_by[-1]
-        shares[str(last_uid)] = round(float(shares.get(str(last_uid), 0)) + diff, 2)
-
-    # Handle paid shares and owed shares
-    for i, uid in enumerate(owed_by):
-        data[f"users__{i}__user_id"] = uid
-        # Set paid share
-        if uid == expense["paid_by"]:
-            data[f"users__{i}__paid_share"] = "{:.2f}".format(float(expense["cost"]))
-        else:
-            data[f"users__{i}__paid_share"] = "0.00"
-        # Get owed share from shares dict or calculate equal split
-        share = shares.get(str(uid))
-        if share is None:
-            share = cost / len(owed_by)
-        data[f"users__{i}__owed_share"] = "{:.2f}".format(float(share))
+    equal = cost / len(owed_by) if owed_by else 0.0
+    owed = [round(float(shares.get(str(uid), equal)), 2) for uid in owed_by]
+    # --- Fix: Ensure shares sum exactly to total cost ---
+    diff = round(cost - sum(owed), 2)
+    if diff and owed:
+        # The last participant absorbs the difference
+        owed[-1] = round(owed[-1] + diff, 2)
+
+    paid_by = expense["paid_by"]
+    paid = f"{cost:.2f}"
+    data.update({
+        key: value
+        for i, (uid, share) in enumerate(zip(owed_by, owed))
+        for key, value in zip(user_field_keys(i), (
+            uid,
+            paid if uid == paid_by else "0.00",
+            f"{share:.2f}",
+        ))
+    })
 
     try:
-        async with httpx.AsyncClient() as client:
-            res = await client.post(url, data=data, headers=headers)
-            res.raise_for_status()
-            return res.json()
+        res = await splitwise_client.post(url, data=data, headers=headers)
+        res.raise_for_status()
+        result = orjson.loads(res.content)
     except Exception as e:
-        logging.error(f"Splitwise API error: {e}")
+        logging.error("Splitwise API error: %s", e)
         raise HTTPException(status_code=502, detail="Splitwise error")
+    created = result.get("expenses") if isinstance(result, dict) else None
+    if created:
+        last_expense_ids[chat_id] = created[0]["id"]
+    return result
+
+# Per-token locks so concurrent cache misses share one get_friends call
+friends_fetch_locks = weakref.WeakValueDictionary()
+
+async def get_splitwise_friends(token: str, use_cache: bool = True):
+    # Balances live on the friend objects, so balance commands pass use_cache=False
+    if not use_cache:
+        return await fetch_splitwise_friends(token)
+    if token in friends_cache:
+        return friends_cache[token]
+    lock = friends_fetch_locks.get(token)
+    if lock is None:
+        lock = friends_fetch_locks[token] = asyncio.Lock()
+    async with lock:
+        # Another message may have filled the cache while this one waited
+        if token in friends_cache:
+            return friends_cache[token]
+        return await fetch_splitwise_friends(token)
+
+async def fetch_splitwise_friends(token: str):
+    url = "/api/v3.0/get_friends"
+    headers = auth_headers(token)
+    res = await splitwise_client.get(url, headers=headers)
+    res.raise_for_status()
+    friends = orjson.loads(res.content)["friends"]
+    friends_cache[token] = friends
+    return friends
+
+def invalidate_friends(token: str):
+    friends_cache.pop(token, None)
+    friend_index_cache.pop(token, None)
+
+async def resolve_friends(token: str, name: str, use_cache: bool = True):
+    """Friends whose first or last name contains name, case-insensitively, in Splitwise order"""
+    name = name.lower()
+    friends = await get_splitwise_friends(token, use_cache=use_cache)
+    return [f for f in friends if name in (f.get("first_name") or "").lower() or name in (f.get("last_name") or "").lower()]
+
+async def get_splitwise_categories(token: str):
+    """Flattened categories and their lowercase-name index, as one cached pair"""
+    # Categories are global to Splitwise, so one flattened copy serves every user
+    cached = categories_cache.get("all")
+    if cached is not None:
+        return cached
+    url = "/api/v3.0/get_categories"
+    headers = auth_headers(token)
+    res = await splitwise_client.get(url, headers=headers)
+    res.raise_for_status()
+    categories = []
+    for parent in orjson.loads(res.content).get("categories", []):
+        for cat in [parent, *parent.get("subcategories", [])]:
+            categories.append({"id": cat["id"], "name": cat["name"], "name_lower": cat["name"].lower()})
+    # setdefault keeps the first category for duplicate names
+    by_name = {}
+    for cat in categories:
+        by_name.setdefault(cat["name_lower"], cat)
+    cached = categories_cache["all"] = (categories, by_name)
+    return cached
+
+async def find_category(token: str, name: str):
+    """Category named name, else the first whose name contains it, case-insensitively"""
+    categories, by_name = await get_splitwise_categories(token)
+    name = name.lower()
+    exact = by_name.get(name)
+    if exact is not None:
+        return exact
+    return next((c for c in categories if name in c["name_lower"]), None)
+
+# Words that always refer to the user themselves
+SELF_REFERENCES = frozenset({"me", "mine", "self", "i"})
+
+class FriendNameIndex:
+    """Lowercased friend names for substring lookups.
+
+    Names are searched in one NUL-joined buffer with str.find, in the same
+    friend order as a linear scan, so the first friend whose name contains the
+    query still wins even when a later friend's name is an exact match.
+    """
+    __slots__ = ("haystack", "starts", "ids", "friend_ids")
+
+    def __init__(self, friends):
+        self.friend_ids = frozenset(friend["id"] for friend in friends)
+        self.starts = []
+        self.ids = []
+        names = []
+        offset = 0
+        for friend in friends:
+            for key in ("first_name", "last_name"):
+                name = (friend.get(key) or "").lower()
+                if not name:
+                    continue
+                self.starts.append(offset)
+                self.ids.append(friend["id"])
+                names.append(name)
+                offset += len(name) + 1
+        self.haystack = "\0".join(names)
+
+    def lookup(self, name: str):
+        if not name or "\0" in name:
+            return None
+        pos = self.haystack.find(name)
+        if pos < 0:
+            return None
+        return self.ids[bisect.bisect_right(self.starts, pos) - 1]
 
-async def get_splitwise_friends(token: str):
-    url = "https://secure.splitwise.com/api/v3.0/get_friends"
-    headers = {"Authorization": f"Bearer {token}"}
-    async with httpx.AsyncClient() as client:
-        res = await client.get(url, headers=headers)
-        res.raise_for_status()
-        return res.json()["friends"]
+def friend_name_index(token: str, friends) -> FriendNameIndex:
+    entry = friend_index_cache.get(token)
+    if entry is None or entry[0] is not friends:
+        entry = (friends, FriendNameIndex(friends))
+        friend_index_cache[token] = entry
+    return entry[1]
 
-def match_name_to_user_id(name, friends, self_user_id=None, self_name=None):
+def match_name_to_user_id(name, friends, self_user_id=None, self_name=None, name_index=None):
     # If name is an int and matches self or a friend, return it
     if isinstance(name, int):
         if self_user_id and name == self_user_id:
             return self_user_id
+        if name_index is not None:
+            return name if name in name_index.friend_ids else None
         for friend in friends:
             if name == friend.get("id"):
                 return name
         return None
     # If name is a string, proceed as before
     name = str(name).lower().strip()
-    self_names = ["me", "mine", "self", "i"]
-    if self_name:
-        self_names.append(str(self_name).lower())
-    if self_user_id and name in self_names:
+    if self_user_id and name in SELF_REFERENCES:
         return self_user_id
     if self_name and name == str(self_name).lower():
         return self_user_id
+    if name_index is not None:
+        return name_index.lookup(name)
     for friend in friends:
         first = (friend.get("first_name") or "").lower()
         last = (friend.get("last_name") or "").lower()
@@ -299,7 +657,7 @@ def match_name_to_user_id(name, friends, self_user_id=None, self_name=None):
             return friend["id"]
     return None
 
-def normalize_expense(parsed, friends, self_user_id, self_name=None, chat_id=None, allow_fake_id=False):
+def normalize_expense(parsed, friends, self_user_id, self_name=None, chat_id=None, allow_fake_id=False, name_index=None):
     # Defensive: check for empty or missing fields
     if not parsed or not isinstance(parsed, dict):
         raise HTTPException(status_code=400, detail="Parsing failed: No data returned from model. Please rephrase your message.")
@@ -307,8 +665,10 @@ def normalize_expense(parsed, friends, self_user_id, self_name=None, chat_id=Non
     participants = parsed.get("participants", [])
     if payer_name is None:
         raise HTTPException(status_code=400, detail="No payer found in parsed expense. Please specify who paid.")
+    if name_index is None:
+        name_index = FriendNameIndex(friends)
     # If payer is 'me', use self_user_id
-    paid_by = match_name_to_user_id(payer_name, friends, self_user_id, self_name)
+    paid_by = match_name_to_user_id(payer_name, friends, self_user_id, self_name, name_index)
     if paid_by is None:
         raise HTTPException(status_code=400, detail=f"Could not match payer name: {payer_name}")
     owed_by = []
@@ -319,7 +679,7 @@ def normalize_expense(parsed, friends, self_user_id, self_name=None, chat_id=Non
         share = part.get("share")
         if name is None:
             raise HTTPException(status_code=400, detail="No participant name found in parsed expense. Please specify all participants.")
-        uid = match_name_to_user_id(name, friends, self_user_id, self_name)
+        uid = match_name_to_user_id(name, friends, self_user_id, self_name, name_index)
         if uid is None and not allow_fake_id:
             unknown_friend = name
             break
@@ -335,6 +695,7 @@ def normalize_expense(parsed, friends, self_user_id, self_name=None, chat_id=Non
             "friend_name": unknown_friend,
             "parsed": parsed,
             "friends": friends,
+            "name_index": name_index,
             "self_user_id": self_user_id,
             "self_name": self_name
         }
@@ -367,36 +728,127 @@ def normalize_expense(parsed, friends, self_user_id, self_name=None, chat_id=Non
     }
 
 # ----------- Telegram Messaging -----------
+# Bound concurrent sends and retry only failures where Telegram never got the
+# message (connect errors, 429), so a retry cannot produce a duplicate
+TELEGRAM_SEND_ATTEMPTS = 3
+# Longer flood waits are not worth holding a reply for; the last attempt just gives up
+TELEGRAM_MAX_RETRY_AFTER = 5
+# A reply that takes longer than this is not worth holding a send slot for
+TELEGRAM_SEND_TIMEOUT = httpx.Timeout(5.0)
+telegram_send_semaphore = asyncio.Semaphore(100)
+
 async def send_telegram_message(chat_id: str, text: str):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = "/sendMessage"
     payload = {"chat_id": chat_id, "text": text}
+    logging.debug("Sending Telegram message to %s: %s", chat_id, text)
+    for attempt in range(TELEGRAM_SEND_ATTEMPTS):
+        delay = 0.25 * 2 ** attempt
+        try:
+            # Hold a slot only for the request itself, so backoff never blocks other chats' sends
+            async with telegram_send_semaphore:
+                res = await telegram_client.post(url, json=payload, timeout=TELEGRAM_SEND_TIMEOUT)
+            if res.status_code != 429:
+                return
+            retry_after = orjson.loads(res.content).get("parameters", {}).get("retry_after", delay)
+            delay = min(retry_after, TELEGRAM_MAX_RETRY_AFTER)
+            logging.warning("Telegram rate limited chat %s, retrying in %ss", chat_id, delay)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            logging.warning("Telegram send error: %s", e)
+        except Exception as e:
+            logging.warning("Telegram send error: %s", e)
+            return
+        if attempt + 1 < TELEGRAM_SEND_ATTEMPTS:
+            await asyncio.sleep(delay)
+
+async def send_chat_action(chat_id: str, action: str = "typing"):
+    # Best effort: the indicator is cosmetic, so failures are only logged
+    url = "/sendChatAction"
     try:
-        logging.debug(f"Sending Telegram message to {chat_id}: {text}")
-        async with httpx.AsyncClient() as client:
-            await client.post(url, json=payload)
+        await telegram_client.post(url, json={"chat_id": chat_id, "action": action}, timeout=TELEGRAM_SEND_TIMEOUT)
     except Exception as e:
-        logging.warning(f"Telegram send error: {e}")
+        logging.debug("Telegram chat action error: %s", e)
+
+# ----------- Supermemory -----------
+async def store_memory(chat_id: str, content: str, metadata: dict):
+    # The supermemory SDK is synchronous; keep it off the event loop
+    # Chat messages are mostly the search queries themselves; only new expenses make results stale
+    if metadata.get("type") != "chat_message":
+        search_cache.pop(str(chat_id), None)
+    try:
+        await asyncio.to_thread(
+            supermemory_client.memories.add,
+            content=content,
+            container_tags=[str(chat_id)],
+            metadata=metadata
+        )
+    except Exception as e:
+        logging.warning("supermemory %s store failed: %s", metadata.get('type'), e)
+
+async def search_history(chat_id: str, text: str):
+    # Rerank and query rewriting are slow, and users often resend the same question
+    chat_searches = search_cache.get(chat_id)
+    if chat_searches is None:
+        chat_searches = search_cache[chat_id] = LRUCache(maxsize=32)
+    key = hashlib.blake2b(" ".join(text.split()).casefold().encode(), digest_size=16).hexdigest()
+    results = chat_searches.get(key)
+    if results is None:
+        response = await asyncio.to_thread(
+            supermemory_client.search.execute,
+            q=text,
+            user_id=str(chat_id),
+            limit=5,
+            rerank=True,
+            rewrite_query=True
+        )
+        results = chat_searches[key] = response.results
+    return results
+
+# Memory timestamps only need second precision, so the string is rebuilt once a second
+_last_timestamp = [0, ""]
+
+def utc_timestamp() -> str:
+    now = int(time.time())
+    if now != _last_timestamp[0]:
+        _last_timestamp[:] = [now, datetime.datetime.fromtimestamp(now, datetime.timezone.utc).isoformat()]
+    return _last_timestamp[1]
+
+def chat_message_metadata() -> dict:
+    return {
+        "type": "chat_message",
+        "content_type": "chat_message",
+        "timestamp": utc_timestamp()
+    }
 
 # ----------- Telegram Webhook -----------
 @router.post("/telegram/webhook")
-async def telegram_webhook(req: Request):
+async def telegram_webhook(req: Request, background_tasks: BackgroundTasks):
     logging.debug("Received webhook call")
+    # Reject forged updates before reading or decoding the body
+    if TELEGRAM_WEBHOOK_SECRET:
+        received = req.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(received.encode(), TELEGRAM_WEBHOOK_SECRET.encode()):
+            raise HTTPException(status_code=401, detail="Invalid webhook secret")
     try:
-        payload = await req.json()
-        logging.debug(f"Webhook payload: {payload}")
-    except Exception as e:
-        logging.error(f"Invalid JSON payload: {e}")
+        update = msgspec.json.decode(await req.body(), type=TelegramUpdate)
+        logging.debug("Webhook payload: %s", update)
+    except msgspec.DecodeError as e:
+        logging.error("Invalid JSON payload: %s", e)
         raise HTTPException(status_code=400, detail="Invalid JSON")
 
-    msg = payload.get("message") or payload.get("edited_message")
+    msg = update.message or update.edited_message
     if not msg:
         logging.info("No message in payload, ignoring")
         return {"ok": True}
 
-    chat_id = str(msg.get("chat", {}).get("id"))
-    text = msg.get("text", "").strip()
-    logging.debug(f"Message from {chat_id}: {text}")
+    chat_id = str(msg.chat.id)
+    text = msg.text.strip()
+    logging.debug("Message from %s: %s", chat_id, text)
 
+    # Acknowledge Telegram right away; the message is processed after the response is sent
+    background_tasks.add_task(handle_telegram_message, chat_id, text)
+    return {"ok": True}
+
+async def handle_telegram_message(chat_id: str, text: str):
     # Check for pending new friend correction/creation
     if chat_id in pending_new_friend:
         pending = pending_new_friend[chat_id]
@@ -404,12 +856,13 @@ async def telegram_webhook(req: Request):
         if reply.lower() in ["no", "n"]:
             await send_telegram_message(chat_id, "Okay, not creating a new friend. Expense cancelled.")
             del pending_new_friend[chat_id]
-            return {"ok": True}
+            return
         # Check if reply matches an existing friend
         friends = pending["friends"]
         self_user_id = pending["self_user_id"]
         self_name = pending["self_name"]
-        matched_id = match_name_to_user_id(reply, friends, self_user_id, self_name)
+        name_index = pending["name_index"]
+        matched_id = match_name_to_user_id(reply, friends, self_user_id, self_name, name_index)
         parsed = pending["parsed"]
         if matched_id is not None:
             # Replace the unknown friend's name with the matched friend's id in participants
@@ -417,13 +870,13 @@ async def telegram_webhook(req: Request):
                 if part["name"] == pending["friend_name"]:
                     part["name"] = reply
             try:
-                normalized = normalize_expense(parsed, friends, self_user_id, self_name, allow_fake_id=False)
+                normalized = normalize_expense(parsed, friends, self_user_id, self_name, allow_fake_id=False, name_index=name_index)
                 res = await create_splitwise_expense(chat_id, normalized)
                 await send_telegram_message(chat_id, f"✅ Expense added with corrected friend '{reply}': {normalized['description']} - {format_amount(normalized['cost'], normalized['currency_code'])}")
             except Exception as e:
                 await send_telegram_message(chat_id, f"❌ Error adding expense with corrected friend: {e}")
             del pending_new_friend[chat_id]
-            return {"ok": True}
+            return
         else:
             # Treat as a new friend name, assign fake id
             new_name = reply
@@ -435,26 +888,29 @@ async def telegram_webhook(req: Request):
             try:
                 normalized = normalize_expense(parsed, friends + [{"id": fake_id, "first_name": new_name}], self_user_id, self_name, allow_fake_id=True)
                 res = await create_splitwise_expense(chat_id, normalized)
+                # Splitwise added a friend, so the cached list is stale
+                token = get_user_token(chat_id)
+                if token:
+                    invalidate_friends(token["access_token"])
                 await send_telegram_message(chat_id, f"✅ New friend '{new_name}' created and expense added: {normalized['description']} - {format_amount(normalized['cost'], normalized['currency_code'])}")
             except Exception as e:
                 await send_telegram_message(chat_id, f"❌ Error adding expense with new friend: {e}")
             del pending_new_friend[chat_id]
-            return {"ok": True}
+            return
 
     if text.startswith("/start"):
         try:
-            resp = await start_oauth(int(chat_id))
-            await send_telegram_message(chat_id, f"Authorize here: {resp['auth_url']}")
+            await send_telegram_message(chat_id, f"Authorize here: {build_authorize_url(int(chat_id))}")
         except Exception as e:
             logging.exception("Error starting OAuth")
             await send_telegram_message(chat_id, f"❌ OAuth start error: {e}")
-        return {"ok": True}
+        return
 
     # Check Splitwise token before proceeding
     token = get_user_token(chat_id)
     if not token:
         await send_telegram_message(chat_id, "❌ User not authorized with Splitwise. Send /start to authorize.")
-        return {"ok": True}
+        return
 
     # First check if it's a command
     command_data = parse_command_regex(text)
@@ -463,42 +919,50 @@ async def telegram_webhook(req: Request):
             cmd = command_data["command"]
             if cmd == "show_recent_expenses":
                 await handle_show_recent_expenses(chat_id, token)
-                return {"ok": True}
+                return
             elif cmd == "show_expenses_by_category":
                 await handle_show_expenses_by_category(chat_id, token, command_data.get("category"))
-                return {"ok": True}
+                return
             elif cmd == "show_expenses_with_friend":
                 await handle_show_expenses_with_friend(chat_id, token, command_data.get("friend"))
-                return {"ok": True}
+                return
             elif cmd == "show_balance_with_friend":
                 await handle_show_balance_with_friend(chat_id, token, command_data.get("friend"))
-                return {"ok": True}
+                return
             elif cmd == "show_balances":
                 await handle_show_balances(chat_id, token)
-                return {"ok": True}
+                return
             elif cmd == "delete_expense":
                 await handle_delete_expense(chat_id, token, command_data.get("expense_id"))
-                return {"ok": True}
+                return
             elif cmd == "help":
                 await handle_help(chat_id)
-                return {"ok": True}
+                return
+            elif cmd == "refresh":
+                await handle_refresh(chat_id, token)
+                return
             else:
                 await send_telegram_message(chat_id, "❌ Command recognized but not implemented.")
-                return {"ok": True}
+                return
         except Exception as e:
             logging.exception("Command handling error")
             await send_telegram_message(chat_id, f"❌ Error executing command: {str(e)}")
-            return {"ok": True}
+            return
 
     # If not a command, try to parse as an expense
     try:
         friends = await get_splitwise_friends(token["access_token"])
         parsed = await parse_expense_from_text(text, friends, token["splitwise_name"], token["splitwise_id"])
-        logging.debug(f"Parsed expense: {parsed}")
-        normalized = normalize_expense(parsed, friends, token["splitwise_id"], token["splitwise_name"], chat_id=chat_id)
-        logging.debug(f"Normalized expense: {normalized}")
-        res = await create_splitwise_expense(chat_id, normalized)
-        logging.debug(f"Splitwise response: {res}")
+        logging.debug("Parsed expense: %s", parsed)
+        name_index = friend_name_index(token["access_token"], friends)
+        normalized = normalize_expense(parsed, friends, token["splitwise_id"], token["splitwise_name"], chat_id=chat_id, name_index=name_index)
+        logging.debug("Normalized expense: %s", normalized)
+        # The confirmation needs Splitwise's authoritative split, so show "typing" while it is written
+        res, _ = await asyncio.gather(
+            create_splitwise_expense(chat_id, normalized, token=token),
+            send_chat_action(chat_id)
+        )
+        logging.debug("Splitwise response: %s", res)
         if 'errors' in res and res['errors']:
             await send_telegram_message(chat_id, f"❌ Failed to add expense: {res['errors']}")
         else:
@@ -539,78 +1003,50 @@ async def telegram_webhook(req: Request):
             msg = f"✅ Expense added: {expense_obj.get('description', normalized.get('description'))} - {format_amount(expense_obj.get('cost', normalized.get('cost')), expense_obj.get('currency_code', normalized.get('currency_code', 'INR')))}"
             if split_details:
                 msg += f"\n{split_details}"
-            await send_telegram_message(chat_id, msg)
-            try:
-                supermemory_client.memories.add(
-                    content=text,  # The original user message
-                    container_tags=[str(chat_id)],
-                    metadata={
-                        "type": "expense",
-                        "content_type": "expense",
-                        "description": expense_obj.get("description", normalized.get("description")),
-                        "amount": expense_obj.get("cost", normalized.get("cost")),
-                        "currency": expense_obj.get("currency_code", normalized.get("currency_code", "INR")),
-                        "split": json.dumps(split_meta),
-                        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
-                    }
-                )
-            except Exception as e:
-                logging.warning(f"supermemory expense store failed: {e}")
-            return {"ok": True}
+            # Confirmation and memory write are independent, so run them together
+            await asyncio.gather(
+                send_telegram_message(chat_id, msg),
+                store_memory(chat_id, text, {  # The original user message
+                    "type": "expense",
+                    "content_type": "expense",
+                    "description": expense_obj.get("description", normalized.get("description")),
+                    "amount": expense_obj.get("cost", normalized.get("cost")),
+                    "currency": expense_obj.get("currency_code", normalized.get("currency_code", "INR")),
+                    "split": orjson.dumps(split_meta).decode(),
+                    "timestamp": utc_timestamp()
+                })
+            )
+            return
     except HTTPException as he:
         if he.status_code == 409 and str(he.detail).startswith("PENDING_NEW_FRIEND::"):
             friend_name = str(he.detail).split("::", 1)[1]
             await send_telegram_message(chat_id, f"❌ Could not find anyone named '{friend_name}' in your Splitwise friends. Please reply with the correct friend, a new name to create, or 'no' to cancel.")
-            return {"ok": True}
+            return
         else:
-            logging.warning(f"HTTP error: {he.detail}")
+            logging.warning("HTTP error: %s", he.detail)
             # --- Store as chat message in supermemory if not a command or expense ---
-            try:
-                supermemory_client.memories.add(
-                    content=text,
-                    container_tags=[str(chat_id)],
-                    metadata={
-                        "type": "chat_message",
-                        "content_type": "chat_message",
-                        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
-                    }
-                )
-            except Exception as se:
-                logging.warning(f"supermemory chat_message store failed: {se}")
-            await send_telegram_message(chat_id, f"❌ {he.detail}")
+            await asyncio.gather(
+                store_memory(chat_id, text, chat_message_metadata()),
+                send_telegram_message(chat_id, f"❌ {he.detail}")
+            )
             # Do not return here; proceed to semantic search
     except Exception as e:
         logging.exception("Expense handling error")
         # --- Store as chat message in supermemory if not a command or expense ---
-        try:
-            supermemory_client.memories.add(
-                content=text,
-                container_tags=[str(chat_id)],
-                metadata={
-                    "type": "chat_message",
-                    "content_type": "chat_message",
-                    "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
-                }
-            )
-        except Exception as se:
-            logging.warning(f"supermemory chat_message store failed: {se}")
-        await send_telegram_message(chat_id, "❌ Error processing expense. Please check your message format.")
+        await asyncio.gather(
+            store_memory(chat_id, text, chat_message_metadata()),
+            send_telegram_message(chat_id, "❌ Error processing expense. Please check your message format.")
+        )
         # Do not return here; proceed to semantic search
 
     # If not a command or expense, treat as a search query
     try:
-        results = supermemory_client.search.execute(
-            q=text,
-            user_id=str(chat_id),
-            limit=5,
-            rerank=True,
-            rewrite_query=True
-        )
-        if not results.results:
+        results = await search_history(chat_id, text)
+        if not results:
             await send_telegram_message(chat_id, "No relevant results found in your history.")
         else:
             msg_lines = []
-            for r in results.results:
+            for r in results:
                 snippet = r.chunks[0].content if r.chunks else ""
                 meta = r.metadata or {}
                 if meta.get("content_type") == "expense":
@@ -623,9 +1059,8 @@ async def telegram_webhook(req: Request):
             msg = "Here are the most relevant results I found:\n" + "\n".join(msg_lines)
             await send_telegram_message(chat_id, msg)
     except Exception as e:
-        logging.warning(f"supermemory search in webhook failed: {e}")
+        logging.warning("supermemory search in webhook failed: %s", e)
         await send_telegram_message(chat_id, "Sorry, I couldn't search your history due to an error.")
-    return {"ok": True}
 
 # ----------- Additional API Endpoints -----------
 @router.post("/api/expense")
@@ -646,11 +1081,13 @@ async def api_parse_expense(payload: ParseInput, chat_id: str):
 @router.post("/api/setup-webhook")
 async def setup_telegram_webhook(data: WebhookInput):
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook"
-        async with httpx.AsyncClient() as client:
-            res = await client.post(url, json={"url": data.url})
-            res.raise_for_status()
-        return res.json()
+        url = "/setWebhook"
+        params = {"url": data.url}
+        if TELEGRAM_WEBHOOK_SECRET:
+            params["secret_token"] = TELEGRAM_WEBHOOK_SECRET
+        res = await telegram_client.post(url, json=params)
+        res.raise_for_status()
+        return orjson.loads(res.content)
     except Exception as e:
         logging.exception("Webhook setup failed")
         raise HTTPException(status_code=500, detail="Webhook setup failed")
@@ -666,7 +1103,8 @@ async def search_memories(chat_id: str = Query(...), query: str = Query(...), ty
             ]
         }
     try:
-        results = supermemory_client.search.execute(
+        results = await asyncio.to_thread(
+            supermemory_client.search.execute,
             q=query,
             user_id=str(chat_id),
             limit=10,
@@ -685,23 +1123,22 @@ async def search_memories(chat_id: str = Query(...), query: str = Query(...), ty
         ]
         return JSONResponse(content={"results": formatted})
     except Exception as e:
-        logging.warning(f"supermemory search failed: {e}")
+        logging.warning("supermemory search failed: %s", e)
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 # Include router and root
 app.include_router(router)
 
 @app.get("/")
-def root():
-    return {"status": "running"}
+async def root():
+    return ROOT_RESPONSE
 
 async def validate_expense_clarity(text: str, parsed: dict) -> str | None:
     try:
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        response = client.chat.completions.create(
+        response = await get_openai_client().chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-                {"role": "user", "content": f'The user sent this message: \'{text}\'.\nYou parsed it as: {json.dumps(parsed)}\nDoes this message clearly specify who paid and who owes what? If yes, reply ONLY with \'OK\'. If not, reply with a clarification question to ask the user.'}
+                {"role": "user", "content": f'The user sent this message: \'{text}\'.\nYou parsed it as: {orjson.dumps(parsed).decode()}\nDoes this message clearly specify who paid and who owes what? If yes, reply ONLY with \'OK\'. If not, reply with a clarification question to ask the user.'}
             ]
         )
         content = response.choices[0].message.content.strip()
@@ -709,9 +1146,22 @@ async def validate_expense_clarity(text: str, parsed: dict) -> str | None:
             return None
         return content
     except Exception as e:
-        logging.error(f"Clarity validation error: {e}")
+        logging.error("Clarity validation error: %s", e)
         return None
 
+# All command patterns in one anchored alternation, tried in order; the
+# outer named group that matched is the command name
+COMMAND_RE = re.compile(
+    r"^(?:"
+    r"(?P<show_balances>(?:show|get)\s+balances?)"
+    r"|(?P<show_balance_with_friend>(?:show|get|how\s+much)\s+(?:balance|do\s+i\s+owe)\s+(?:with\s+)?(?P<friend>\w+))"
+    r"|(?P<show_expenses_by_category>show\s+(?:me\s+)?(?P<category>\w+)\s+expenses)"
+    r"|(?P<delete_expense>delete\s+(?:the\s+)?last\s+expense)"
+    r")$",
+    re.I
+)
+COMMAND_ARGS = ("friend", "category")
+
 def parse_command_regex(text: str) -> Optional[dict]:
     """Parse command patterns from text message"""
     # Direct commands
@@ -719,196 +1169,128 @@ def parse_command_regex(text: str) -> Optional[dict]:
         command = text[1:].split()[0].lower()
         return {"command": command}
 
-    # Show balances
-    if re.match(r"^(show|get)\s+balances?$", text, re.I):
-        return {"command": "show_balances"}
-
-    # Show balance with friend
-    friend_balance = re.match(r"^(show|get|how\s+much)\s+(balance|do\s+i\s+owe)\s+(?:with\s+)?(\w+)$", text, re.I)
-    if friend_balance:
-        return {
-            "command": "show_balance_with_friend",
-            "friend": friend_balance.group(3)
-        }
-
-    # Show expenses by category
-    category_match = re.match(r"^show\s+(?:me\s+)?(\w+)\s+expenses$", text, re.I)
-    if category_match:
-        return {
-            "command": "show_expenses_by_category",
-            "category": category_match.group(1)
-        }
-
-    # Delete expense
-    if re.match(r"^delete\s+(?:the\s+)?last\s+expense$", text, re.I):
-        return {"command": "delete_expense"}
-
-    return None
+    match = COMMAND_RE.match(text)
+    if not match:
+        return None
+    parsed = {"command": match.lastgroup}
+    for arg in COMMAND_ARGS:
+        if match[arg]:
+            parsed[arg] = match[arg]
+    return parsed
 
 async def vet_command_with_llm(text, parsed_command):
     prompt = (
         f'The user sent: "{text}".\n'
-        f'My regex parser thinks this means: {json.dumps(parsed_command)}.\n'
+        f'My regex parser thinks this means: {orjson.dumps(parsed_command).decode()}.\n'
         'Is this correct? If yes, reply ONLY with the JSON object. '
         'If not, reply with the correct command and arguments as a JSON object, '
         'or reply with {"command": "unknown"} if you can\'t tell.'
     )
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    response = await asyncio.to_thread(
-        lambda: client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}]
-        )
+    response = await get_openai_client().chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": prompt}],
+        response_format={"type": "json_object"}
     )
-    content = response.choices[0].message.content.strip()
+    content = response.choices[0].message.content
     try:
-        return json.loads(content)
+        return orjson.loads(content)
     except Exception:
         return {"command": "unknown"}
 
 # ----------- Currency Formatting -----------
+CURRENCY_SYMBOLS = {
+    "INR": "₹",
+    "USD": "$",
+    "EUR": "€",
+    "GBP": "£",
+}
+
 def format_amount(amount, currency_code="INR"):
-    try:
-        amount = float(amount)
-    except Exception:
-        return str(amount)
+    # Numbers format directly; Splitwise's string amounts still go through float()
+    if not isinstance(amount, (int, float)):
+        try:
+            amount = float(amount)
+        except Exception:
+            return str(amount)
     currency_code = (currency_code or "INR").upper()
-    symbol_map = {
-        "INR": "₹",
-        "USD": "$",
-        "EUR": "€",
-        "GBP": "£",
-    }
-    symbol = symbol_map.get(currency_code, "")
+    symbol = CURRENCY_SYMBOLS.get(currency_code, "")
     if symbol:
         return f"{symbol}{amount:,.2f}"
     else:
         return f"{amount:,.2f} {currency_code}"
 
 # --- Command Handlers (stubs) ---
+def format_expense_line(e: dict) -> str:
+    return f"{e.get('description', '(No description)')} | {float(e.get('cost', '0')):.2f} {e.get('currency_code', '')} | {e.get('date', '')[:10]}"
+
+def render_expense_list(header: str, expenses: list) -> str:
+    return header + "\n" + "\n".join(map(format_expense_line, expenses))
+
 async def handle_show_recent_expenses(chat_id, token):
-    url = "https://secure.splitwise.com/api/v3.0/get_expenses"
-    headers = {"Authorization": f"Bearer {token['access_token']}"}
+    url = "/api/v3.0/get_expenses"
+    headers = auth_headers(token["access_token"])
     params = {"limit": 5}
     try:
-        async with httpx.AsyncClient() as client:
-            res = await client.get(url, headers=headers, params=params)
-            res.raise_for_status()
-            data = res.json()
-            expenses = data.get("expenses", [])
-            if not expenses:
-                await send_telegram_message(chat_id, "No recent expenses found.")
-                return
-            msg_lines = []
-            for e in expenses:
-                desc = e.get("description", "(No description)")
-                cost = float(e.get("cost", "0"))
-                currency = e.get("currency_code", "")
-                date = e.get("date", "")[:10]
-                msg_lines.append(f"{desc} | {cost:.2f} {currency} | {date}")
-            msg = "Recent expenses:\n" + "\n".join(msg_lines)
-            await send_telegram_message(chat_id, msg)
+        res = await splitwise_client.get(url, headers=headers, params=params)
+        if res.is_error:
+            await send_telegram_message(chat_id, f"❌ Failed to fetch recent expenses: Splitwise returned {res.status_code}")
+            return
+        data = orjson.loads(res.content)
+        expenses = data.get("expenses", [])
+        if not expenses:
+            await send_telegram_message(chat_id, "No recent expenses found.")
+            return
+        msg = render_expense_list("Recent expenses:", expenses)
+        await send_telegram_message(chat_id, msg)
     except Exception as e:
         await send_telegram_message(chat_id, f"❌ Failed to fetch recent expenses: {e}")
 
-async def handle_show_expenses_by_category(chat_id, token, category):
-    cat_url = "https://secure.splitwise.com/api/v3.0/get_categories"
-    headers = {"Authorization": f"Bearer {token['access_token']}"}
-    try:
-        async with httpx.AsyncClient() as client:
-            cat_res = await client.get(cat_url, headers=headers)
-            cat_res.raise_for_status()
-            categories = cat_res.json().get("categories", [])
-            subcats = []
-            for parent in categories:
-                for sub in parent.get("subcategories", []):
-                    subcats.append(sub)
-            cat_name = category.lower()
-            matches = [sub for sub in subcats if cat_name in sub.get("name", "").lower()]
-            if not matches:
-                await send_telegram_message(chat_id, f"❌ Category '{category}' not found.")
-                return
-            if len(matches) > 1:
-                names = ', '.join([sub['name'] for sub in matches])
-                await send_telegram_message(chat_id, f"Multiple categories match '{category}': {names}. Please be more specific.")
-                return
-            cat_id = matches[0]["id"]
-            cat_label = matches[0]["name"]
-            exp_url = "https://secure.splitwise.com/api/v3.0/get_expenses"
-            params = {"category_id": cat_id, "limit": 5}
-            exp_res = await client.get(exp_url, headers=headers, params=params)
-            exp_res.raise_for_status()
-            expenses = exp_res.json().get("expenses", [])
-            if not expenses:
-                await send_telegram_message(chat_id, f"No recent expenses found for category '{cat_label}'.")
-                return
-            msg_lines = []
-            for e in expenses:
-                desc = e.get("description", "(No description)")
-                cost = float(e.get("cost", "0"))
-                currency = e.get("currency_code", "")
-                date = e.get("date", "")[:10]
-                msg_lines.append(f"{desc} | {cost:.2f} {currency} | {date}")
-            msg = f"Recent expenses for '{cat_label}':\n" + "\n".join(msg_lines)
-            await send_telegram_message(chat_id, msg)
-    except Exception as e:
-        await send_telegram_message(chat_id, f"❌ Failed to fetch expenses for category '{category}': {e}")
-
 async def handle_show_expenses_with_friend(chat_id, token, friend):
-    friends_url = "https://secure.splitwise.com/api/v3.0/get_friends"
-    headers = {"Authorization": f"Bearer {token['access_token']}"}
+    headers = auth_headers(token["access_token"])
     try:
-        async with httpx.AsyncClient() as client:
-            friends_res = await client.get(friends_url, headers=headers)
-            friends_res.raise_for_status()
-            friends = friends_res.json().get("friends", [])
-            friend_name = friend.lower()
-            matches = [f for f in friends if friend_name in (f.get("first_name") or "").lower() or friend_name in (f.get("last_name") or "").lower()]
-            if not matches:
-                await send_telegram_message(chat_id, f"❌ Friend '{friend}' not found.")
-                return
-            if len(matches) > 1:
-                names = ', '.join([f.get('first_name', '') for f in matches])
-                await send_telegram_message(chat_id, f"Multiple friends match '{friend}': {names}. Please be more specific.")
-                return
-            friend_id = matches[0]["id"]
-            friend_label = matches[0].get("first_name", "")
-            exp_url = "https://secure.splitwise.com/api/v3.0/get_expenses"
-            params = {"friend_id": friend_id, "limit": 5}
-            exp_res = await client.get(exp_url, headers=headers, params=params)
-            exp_res.raise_for_status()
-            expenses = exp_res.json().get("expenses", [])
-            if not expenses:
-                await send_telegram_message(chat_id, f"No recent expenses found with '{friend_label}'.")
-                return
-            msg_lines = []
-            for e in expenses:
-                desc = e.get("description", "(No description)")
-                cost = float(e.get("cost", "0"))
-                currency = e.get("currency_code", "")
-                date = e.get("date", "")[:10]
-                msg_lines.append(f"{desc} | {cost:.2f} {currency} | {date}")
-            msg = f"Recent expenses with '{friend_label}':\n" + "\n".join(msg_lines)
-            await send_telegram_message(chat_id, msg)
+        matches = await resolve_friends(token["access_token"], friend)
+        if not matches:
+            await send_telegram_message(chat_id, f"❌ Friend '{friend}' not found.")
+            return
+        if len(matches) > 1:
+            names = ', '.join([f.get('first_name', '') for f in matches])
+            await send_telegram_message(chat_id, f"Multiple friends match '{friend}': {names}. Please be more specific.")
+            return
+        friend_id = matches[0]["id"]
+        friend_label = matches[0].get("first_name", "")
+        exp_url = "/api/v3.0/get_expenses"
+        params = {"friend_id": friend_id, "limit": 5}
+        exp_res = await splitwise_client.get(exp_url, headers=headers, params=params)
+        if exp_res.is_error:
+            await send_telegram_message(chat_id, f"❌ Failed to fetch expenses with '{friend}': Splitwise returned {exp_res.status_code}")
+            return
+        expenses = orjson.loads(exp_res.content).get("expenses", [])
+        if not expenses:
+            await send_telegram_message(chat_id, f"No recent expenses found with '{friend_label}'.")
+            return
+        msg = render_expense_list(f"Recent expenses with '{friend_label}':", expenses)
+        await send_telegram_message(chat_id, msg)
     except Exception as e:
         await send_telegram_message(chat_id, f"❌ Failed to fetch expenses with '{friend}': {e}")
 
 async def handle_show_balances(chat_id: str, token: dict):
     """Handle showing all balances"""
-    friends = await get_splitwise_friends(token["access_token"])
+    friends = await get_splitwise_friends(token["access_token"], use_cache=False)
     if not friends:
         await send_telegram_message(chat_id, "No friends found.")
         return
 
-    message = "💰 Your balances:\n\n"
+    lines = []
     for friend in friends:
-        balance = friend.get("balance", [{}])[0].get("amount", "0")
-        currency = friend.get("balance", [{}])[0].get("currency_code", "INR")
-        name = f"{friend.get('first_name', '')} {friend.get('last_name', '')}".strip()
-        if float(balance) != 0:
-            symbol = "🔴" if float(balance) < 0 else "🟢"
-            message += f"{symbol} {name}: {format_amount(balance, currency)}\n"
-    
+        # Settled friends come back with an empty balance list
+        entry = (friend.get("balance") or [{}])[0]
+        amount = float(entry.get("amount") or 0)
+        if amount:
+            name = f"{friend.get('first_name', '')} {friend.get('last_name', '')}".strip()
+            symbol = "🔴" if amount < 0 else "🟢"
+            lines.append(f"{symbol} {name}: {format_amount(amount, entry.get('currency_code', 'INR'))}\n")
+    message = "💰 Your balances:\n\n" + "".join(lines)
+
     await send_telegram_message(chat_id, message)
 
 async def handle_show_balance_with_friend(chat_id: str, token: dict, friend_name: str):
@@ -917,21 +1299,22 @@ async def handle_show_balance_with_friend(chat_id: str, token: dict, friend_name
         await send_telegram_message(chat_id, "Please specify a friend's name.")
         return
 
-    friends = await get_splitwise_friends(token["access_token"])
-    friend = next((f for f in friends if friend_name.lower() in f["first_name"].lower()), None)
+    matches = await resolve_friends(token["access_token"], friend_name, use_cache=False)
+    friend = matches[0] if matches else None
     
     if not friend:
         await send_telegram_message(chat_id, f"Friend '{friend_name}' not found.")
         return
 
-    balance = friend.get("balance", [{}])[0].get("amount", "0")
-    currency = friend.get("balance", [{}])[0].get("currency_code", "INR")
+    entry = (friend.get("balance") or [{}])[0]
+    balance = float(entry.get("amount") or 0)
+    currency = entry.get("currency_code", "INR")
     name = f"{friend.get('first_name', '')} {friend.get('last_name', '')}".strip()
     
-    if float(balance) == 0:
+    if balance == 0:
         message = f"👌 You're all settled with {name}!"
-    elif float(balance) < 0:
-        message = f"🔴 You owe {name}: {format_amount(abs(float(balance)), currency)}"
+    elif balance < 0:
+        message = f"🔴 You owe {name}: {format_amount(-balance, currency)}"
     else:
         message = f"🟢 {name} owes you: {format_amount(balance, currency)}"
     
@@ -943,83 +1326,77 @@ async def handle_show_expenses_by_category(chat_id: str, token: dict, category:
         await send_telegram_message(chat_id, "Please specify a category.")
         return
 
-    # Get all categories first
-    async with httpx.AsyncClient() as client:
-        res = await client.get(
-            "https://secure.splitwise.com/api/v3.0/get_categories",
-            headers={"Authorization": f"Bearer {token['access_token']}"}
-        )
-        res.raise_for_status()
-        categories = res.json().get("categories", [])
-
     # Find matching category
-    category_lower = category.lower()
-    matched_category = None
-    for cat in categories:
-        if category_lower in cat["name"].lower():
-            matched_category = cat
-            break
-        for subcat in cat.get("subcategories", []):
-            if category_lower in subcat["name"].lower():
-                matched_category = subcat
-                break
-        if matched_category:
-            break
+    matched_category = await find_category(token["access_token"], category)
 
     if not matched_category:
         await send_telegram_message(chat_id, f"Category '{category}' not found.")
         return
 
     # Get expenses for this category
-    async with httpx.AsyncClient() as client:
-        res = await client.get(
-            "https://secure.splitwise.com/api/v3.0/get_expenses",
-            params={"limit": 10, "category_id": matched_category["id"]},
-            headers={"Authorization": f"Bearer {token['access_token']}"}
-        )
-        res.raise_for_status()
-        expenses = res.json().get("expenses", [])
+    res = await splitwise_client.get(
+        "/api/v3.0/get_expenses",
+        params={"limit": 10, "category_id": matched_category["id"]},
+        headers=auth_headers(token["access_token"])
+    )
+    if res.is_error:
+        await send_telegram_message(chat_id, f"❌ Failed to fetch expenses for category '{category}': Splitwise returned {res.status_code}")
+        return
+    expenses = orjson.loads(res.content).get("expenses", [])
 
     if not expenses:
         await send_telegram_message(chat_id, f"No recent expenses found in category '{matched_category['name']}'.")
         return
 
-    message = f"📊 Recent {matched_category['name']} expenses:\n\n"
-    for exp in expenses:
-        date = exp.get("date", "").split("T")[0]
-        cost = exp.get("cost")
-        currency = exp.get("currency_code", "INR")
-        message += f"• {date} - {exp.get('description')}: {format_amount(cost, currency)}\n"
+    message = f"📊 Recent {matched_category['name']} expenses:\n\n" + "".join([
+        f"• {exp.get('date', '').split('T')[0]} - {exp.get('description')}: {format_amount(exp.get('cost'), exp.get('currency_code', 'INR'))}\n"
+        for exp in expenses
+    ])
     
     await send_telegram_message(chat_id, message)
 
 async def handle_delete_expense(chat_id: str, token: dict, expense_id: Optional[int] = None):
     """Handle deleting an expense"""
-    # Get most recent expense if no ID provided
+    # Prefer the expense this bot created last; otherwise ask Splitwise for the most recent one
+    # The remembered id is only forgotten once Splitwise confirms it is gone, so a failed
+    # delete is retried against the same expense instead of whatever is newest
     if not expense_id:
-        async with httpx.AsyncClient() as client:
-            res = await client.get(
-                "https://secure.splitwise.com/api/v3.0/get_expenses",
-                params={"limit": 1},
-                headers={"Authorization": f"Bearer {token['access_token']}"}
-            )
-            res.raise_for_status()
-            expenses = res.json().get("expenses", [])
-            if not expenses:
-                await send_telegram_message(chat_id, "No recent expenses found.")
-                return
-            expense_id = expenses[0]["id"]
+        expense_id = last_expense_ids.get(chat_id)
+    if not expense_id:
+        res = await splitwise_client.get(
+            "/api/v3.0/get_expenses",
+            params={"limit": 1},
+            headers=auth_headers(token["access_token"])
+        )
+        if res.is_error:
+            await send_telegram_message(chat_id, f"❌ Failed to find your last expense: Splitwise returned {res.status_code}")
+            return
+        expenses = orjson.loads(res.content).get("expenses", [])
+        if not expenses:
+            await send_telegram_message(chat_id, "No recent expenses found.")
+            return
+        expense_id = expenses[0]["id"]
 
     # Delete the expense
-    async with httpx.AsyncClient() as client:
-        res = await client.post(
-            f"https://secure.splitwise.com/api/v3.0/delete_expense/{expense_id}",
-            headers={"Authorization": f"Bearer {token['access_token']}"}
-        )
-        res.raise_for_status()
-        
+    res = await splitwise_client.post(
+        f"/api/v3.0/delete_expense/{expense_id}",
+        headers=auth_headers(token["access_token"])
+    )
+    if res.status_code == 404 and last_expense_ids.get(chat_id) == expense_id:
+        last_expense_ids.pop(chat_id, None)
+    if res.is_error:
+        await send_telegram_message(chat_id, f"❌ Failed to delete expense: Splitwise returned {res.status_code}")
+        return
+
+    if last_expense_ids.get(chat_id) == expense_id:
+        last_expense_ids.pop(chat_id, None)
     await send_telegram_message(chat_id, "✅ Expense deleted successfully!")
 
+async def handle_refresh(chat_id: str, token: dict):
+    """Handle refresh command: drop cached Splitwise data for this user"""
+    invalidate_friends(token["access_token"])
+    await send_telegram_message(chat_id, "🔄 Refreshed your Splitwise friends.")
+
 async def handle_help(chat_id: str):
     """Handle help command"""
     help_text = """
@@ -1045,9 +1422,20 @@ async def handle_help(chat_id: str):
 • Other commands:
   - /start - Connect Splitwise
   - /help - Show this help
+  - /refresh - Reload your Splitwise friends
 """
     await send_telegram_message(chat_id, help_text)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
+    # Pending friend/expense state is held in-process, so keep one worker unless overridden
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=PORT,
+        loop="uvloop",
+        http="httptools",
+        workers=WEB_CONCURRENCY,
+        limit_concurrency=1000,
+        timeout_keep_alive=30
+    )
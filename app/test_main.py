@@ -1,6 +1,7 @@
 import pytest
+import httpx
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
 import json
 import os
 from app.main import app
@@ -13,6 +14,28 @@ TEST_TOKEN = "test_token"
 TEST_SPLITWISE_ID = 12345
 TEST_SPLITWISE_NAME = "TestUser"
 
+def mock_response(status_code, data=None, text=None):
+    """Build a real httpx response so .content, .json() and raise_for_status() behave"""
+    request = httpx.Request("GET", "https://test")
+    if data is not None:
+        return httpx.Response(status_code, json=data, request=request)
+    return httpx.Response(status_code, text=text or "", request=request)
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Start every test with empty in-process caches"""
+    from app import main
+    main.friends_cache.clear()
+    main.friend_index_cache.clear()
+    main.prompt_context_cache.clear()
+    main.categories_cache.clear()
+    main.current_user_cache.clear()
+    main.last_expense_ids.clear()
+    main.consumed_oauth_codes.clear()
+    main.parse_cache.clear()
+    main.search_cache.clear()
+    yield
+
 @pytest.fixture
 def mock_token_storage():
     """Mock token storage for tests"""
@@ -23,7 +46,7 @@ def mock_token_storage():
             "splitwise_name": TEST_SPLITWISE_NAME
         }
     }
-    with patch('app.main.load_json', return_value=tokens):
+    with patch.dict('app.main.user_tokens', tokens, clear=True):
         yield tokens
 
 @pytest.fixture
@@ -83,38 +106,52 @@ async def test_oauth_callback_success():
             "first_name": TEST_SPLITWISE_NAME
         }
     }
-    with patch('httpx.AsyncClient.post', return_value=MagicMock(
-        status_code=200,
-        json=lambda: mock_token_response
-    )), patch('httpx.AsyncClient.get', return_value=MagicMock(
-        status_code=200,
-        json=lambda: mock_user_response
-    )):
+    with patch('httpx.AsyncClient.post', return_value=mock_response(200, mock_token_response)), \
+         patch('httpx.AsyncClient.get', return_value=mock_response(200, mock_user_response)):
         response = client.get(f"/auth/splitwise/callback?code=test_code&state={TEST_CHAT_ID}")
         assert response.status_code == 200
         assert response.json() == {"status": "authorized"}
 
+@pytest.mark.asyncio
+async def test_oauth_callback_repeated_code():
+    """Test a replayed callback does not exchange the same code twice"""
+    mock_token_response = {"access_token": "new_test_token", "token_type": "Bearer"}
+    mock_user_response = {"user": {"id": TEST_SPLITWISE_ID, "first_name": TEST_SPLITWISE_NAME}}
+    with patch('httpx.AsyncClient.post', return_value=mock_response(200, mock_token_response)) as mock_post, \
+         patch('httpx.AsyncClient.get', return_value=mock_response(200, mock_user_response)), \
+         patch('app.main.send_telegram_message'):
+        for _ in range(2):
+            response = client.get(f"/auth/splitwise/callback?code=once&state={TEST_CHAT_ID}")
+            assert response.json() == {"status": "authorized"}
+        assert mock_post.call_count == 1
+
 @pytest.mark.asyncio
 async def test_oauth_callback_failure():
     """Test failed OAuth callback"""
-    with patch('httpx.AsyncClient.post', return_value=MagicMock(
-        status_code=400,
-        text="Invalid code"
-    )):
+    with patch('httpx.AsyncClient.post', return_value=mock_response(400, text="Invalid code")):
         response = client.get(f"/auth/splitwise/callback?code=invalid_code&state={TEST_CHAT_ID}")
         assert response.status_code == 502
 
 @pytest.mark.asyncio
 async def test_webhook_setup():
     """Test webhook setup endpoint"""
-    mock_response = {"ok": True, "result": True}
-    with patch('httpx.AsyncClient.post', return_value=MagicMock(
-        status_code=200,
-        json=lambda: mock_response
-    )):
+    telegram_response = {"ok": True, "result": True}
+    with patch('httpx.AsyncClient.post', return_value=mock_response(200, telegram_response)):
         response = client.post("/api/setup-webhook", json={"url": "https://test.com/webhook"})
         assert response.status_code == 200
-        assert response.json() == mock_response
+        assert response.json() == telegram_response
+
+def test_get_user_token_reads_tokens_saved_by_another_worker():
+    """Test a cache miss falls through to SQLite, where another worker may have saved the token"""
+    from app import main
+    main.tokens_conn.execute(main.UPSERT_TOKEN_SQL, ("555", "other_worker_token", 42, "Other"))
+    try:
+        with patch.dict('app.main.user_tokens', {}, clear=True):
+            assert main.get_user_token("555") == {"access_token": "other_worker_token", "splitwise_id": 42, "splitwise_name": "Other"}
+            assert "555" in main.user_tokens
+            assert main.get_user_token("556") is None
+    finally:
+        main.tokens_conn.execute("DELETE FROM tokens WHERE chat_id = ?", ("555",))
 
 @pytest.mark.asyncio
 async def test_unauthorized_expense(mock_token_storage):
@@ -193,11 +230,9 @@ async def test_specific_split_expense(mock_token_storage, mock_splitwise_friends
 @pytest.mark.asyncio
 async def test_show_balances(mock_token_storage, mock_splitwise_friends):
     """Test showing user balances"""
-    with patch('httpx.AsyncClient.get', return_value=MagicMock(
-        status_code=200,
-        json=lambda: mock_splitwise_friends
-    )), patch('app.main.send_telegram_message') as mock_send, \
-       patch('app.main.parse_command_regex', return_value={"command": "show_balances"}):
+    with patch('httpx.AsyncClient.get', return_value=mock_response(200, mock_splitwise_friends)), \
+         patch('app.main.send_telegram_message') as mock_send, \
+         patch('app.main.parse_command_regex', return_value={"command": "show_balances"}):
         webhook_data = {
             "message": {
                 "chat": {"id": TEST_CHAT_ID},
@@ -213,10 +248,8 @@ async def test_show_balances(mock_token_storage, mock_splitwise_friends):
 @pytest.mark.asyncio
 async def test_show_friend_balance(mock_token_storage, mock_splitwise_friends):
     """Test showing balance with specific friend"""
-    with patch('httpx.AsyncClient.get', return_value=MagicMock(
-        status_code=200,
-        json=lambda: mock_splitwise_friends
-    )), patch('app.main.send_telegram_message') as mock_send:
+    with patch('httpx.AsyncClient.get', return_value=mock_response(200, mock_splitwise_friends)), \
+         patch('app.main.send_telegram_message') as mock_send:
         webhook_data = {
             "message": {
                 "chat": {"id": TEST_CHAT_ID},
@@ -229,6 +262,24 @@ async def test_show_friend_balance(mock_token_storage, mock_splitwise_friends):
         call_args = mock_send.call_args[0]
         assert "John" in call_args[1]
 
+@pytest.mark.asyncio
+async def test_show_balances_skips_settled_friends(mock_token_storage, mock_splitwise_friends):
+    """Settled friends come back with an empty balance list"""
+    mock_splitwise_friends["friends"].append({"id": 67892, "first_name": "Bob", "last_name": "", "balance": []})
+    with patch('httpx.AsyncClient.get', return_value=mock_response(200, mock_splitwise_friends)), \
+         patch('app.main.send_telegram_message') as mock_send:
+        webhook_data = {
+            "message": {
+                "chat": {"id": TEST_CHAT_ID},
+                "text": "show balances"
+            }
+        }
+        response = client.post("/telegram/webhook", json=webhook_data)
+        assert response.status_code == 200
+        message = mock_send.call_args[0][1]
+        assert "John Doe: ₹-100.00" in message
+        assert "Bob" not in message
+
 @pytest.mark.asyncio
 async def test_delete_last_expense(mock_token_storage):
     """Test deleting the last expense"""
@@ -239,13 +290,9 @@ async def test_delete_last_expense(mock_token_storage):
             "cost": "100.0"
         }]
     }
-    with patch('httpx.AsyncClient.get', return_value=MagicMock(
-        status_code=200,
-        json=lambda: mock_expense
-    )), patch('httpx.AsyncClient.post', return_value=MagicMock(
-        status_code=200,
-        json=lambda: {"success": True}
-    )), patch('app.main.send_telegram_message') as mock_send:
+    with patch('httpx.AsyncClient.get', return_value=mock_response(200, mock_expense)), \
+         patch('httpx.AsyncClient.post', return_value=mock_response(200, {"success": True})), \
+         patch('app.main.send_telegram_message') as mock_send:
         webhook_data = {
             "message": {
                 "chat": {"id": TEST_CHAT_ID},
@@ -258,6 +305,57 @@ async def test_delete_last_expense(mock_token_storage):
         call_args = mock_send.call_args[0]
         assert "deleted" in call_args[1].lower()
 
+@pytest.mark.asyncio
+async def test_create_then_delete_skips_lookup(mock_token_storage):
+    """Test deleting right after creating uses the remembered expense id"""
+    from app.main import create_splitwise_expense, handle_delete_expense
+    expense = {"cost": 10, "description": "Tea", "paid_by": TEST_SPLITWISE_ID, "owed_by": [TEST_SPLITWISE_ID]}
+    with patch('httpx.AsyncClient.post', return_value=mock_response(200, {"expenses": [{"id": 777}]})):
+        await create_splitwise_expense(TEST_CHAT_ID, expense)
+    with patch('httpx.AsyncClient.get') as mock_get, \
+         patch('httpx.AsyncClient.post', return_value=mock_response(200, {"success": True})) as mock_post, \
+         patch('app.main.send_telegram_message'):
+        await handle_delete_expense(TEST_CHAT_ID, mock_token_storage[TEST_CHAT_ID])
+    mock_get.assert_not_called()
+    assert mock_post.call_args[0][0].endswith("/delete_expense/777")
+
+@pytest.mark.asyncio
+async def test_failed_delete_retries_remembered_expense(mock_token_storage):
+    """Test a failed delete keeps the remembered id so the retry targets the same expense"""
+    from app import main
+    main.last_expense_ids[TEST_CHAT_ID] = 777
+    token = mock_token_storage[TEST_CHAT_ID]
+    with patch('httpx.AsyncClient.get') as mock_get, \
+         patch('httpx.AsyncClient.post', return_value=mock_response(500, {"errors": {}})), \
+         patch('app.main.send_telegram_message'):
+        await main.handle_delete_expense(TEST_CHAT_ID, token)
+    assert main.last_expense_ids[TEST_CHAT_ID] == 777
+    with patch('httpx.AsyncClient.get') as mock_get, \
+         patch('httpx.AsyncClient.post', return_value=mock_response(200, {"success": True})) as mock_post, \
+         patch('app.main.send_telegram_message'):
+        await main.handle_delete_expense(TEST_CHAT_ID, token)
+    mock_get.assert_not_called()
+    assert mock_post.call_args[0][0].endswith("/delete_expense/777")
+    assert TEST_CHAT_ID not in main.last_expense_ids
+
+@pytest.mark.asyncio
+async def test_delete_expense_splitwise_error(mock_token_storage):
+    """Test a Splitwise error response is reported instead of raised"""
+    mock_expense = {"expenses": [{"id": 12345}]}
+    with patch('httpx.AsyncClient.get', return_value=mock_response(200, mock_expense)), \
+         patch('httpx.AsyncClient.post', return_value=mock_response(404, {"errors": {"base": ["Not found"]}})), \
+         patch('app.main.send_telegram_message') as mock_send:
+        webhook_data = {
+            "message": {
+                "chat": {"id": TEST_CHAT_ID},
+                "text": "delete last expense"
+            }
+        }
+        response = client.post("/telegram/webhook", json=webhook_data)
+        assert response.status_code == 200
+        mock_send.assert_called_once()
+        assert "404" in mock_send.call_args[0][1]
+
 @pytest.mark.asyncio
 async def test_show_category_expenses(mock_token_storage):
     """Test showing expenses by category"""
@@ -280,8 +378,8 @@ async def test_show_category_expenses(mock_token_storage):
         }]
     }
     with patch('httpx.AsyncClient.get', side_effect=[
-        MagicMock(status_code=200, json=lambda: mock_categories),
-        MagicMock(status_code=200, json=lambda: mock_expenses)
+        mock_response(200, mock_categories),
+        mock_response(200, mock_expenses)
     ]), patch('app.main.send_telegram_message') as mock_send:
         webhook_data = {
             "message": {
@@ -308,10 +406,8 @@ async def test_invalid_category(mock_token_storage):
             }]
         }]
     }
-    with patch('httpx.AsyncClient.get', return_value=MagicMock(
-        status_code=200,
-        json=lambda: mock_categories
-    )), patch('app.main.send_telegram_message') as mock_send:
+    with patch('httpx.AsyncClient.get', return_value=mock_response(200, mock_categories)), \
+         patch('app.main.send_telegram_message') as mock_send:
         webhook_data = {
             "message": {
                 "chat": {"id": TEST_CHAT_ID},
@@ -324,6 +420,21 @@ async def test_invalid_category(mock_token_storage):
         call_args = mock_send.call_args[0]
         assert "not found" in call_args[1].lower()
 
+@pytest.mark.asyncio
+async def test_find_category_prefers_exact_name():
+    from app.main import find_category
+    mock_categories = {
+        "categories": [{
+            "name": "Food & Drink",
+            "id": 1,
+            "subcategories": [{"name": "Food", "id": 101}]
+        }]
+    }
+    with patch('httpx.AsyncClient.get', return_value=mock_response(200, mock_categories)):
+        assert (await find_category(TEST_TOKEN, "Food"))["id"] == 101
+        assert (await find_category(TEST_TOKEN, "drink"))["id"] == 1
+        assert await find_category(TEST_TOKEN, "xyz") is None
+
 @pytest.mark.asyncio
 async def test_help_command():
     """Test help command"""
@@ -340,6 +451,138 @@ async def test_help_command():
         call_args = mock_send.call_args[0]
         assert "available commands" in call_args[1].lower()
 
+@pytest.mark.asyncio
+async def test_refresh_command_clears_friends_cache(mock_token_storage, mock_splitwise_friends):
+    """Test /refresh drops the cached friends list"""
+    from app import main
+    main.friends_cache[TEST_TOKEN] = mock_splitwise_friends["friends"]
+    with patch('app.main.send_telegram_message') as mock_send:
+        webhook_data = {
+            "message": {
+                "chat": {"id": TEST_CHAT_ID},
+                "text": "/refresh"
+            }
+        }
+        response = client.post("/telegram/webhook", json=webhook_data)
+        assert response.status_code == 200
+        assert TEST_TOKEN not in main.friends_cache
+        mock_send.assert_called_once()
+        assert "refreshed" in mock_send.call_args[0][1].lower()
+
+@pytest.mark.parametrize("text,expected", [
+    ("show balances", {"command": "show_balances"}),
+    ("Get balance", {"command": "show_balances"}),
+    ("how much do I owe John", {"command": "show_balance_with_friend", "friend": "John"}),
+    ("show balance with Alice", {"command": "show_balance_with_friend", "friend": "Alice"}),
+    ("show me food expenses", {"command": "show_expenses_by_category", "category": "food"}),
+    ("delete the last expense", {"command": "delete_expense"}),
+    ("/help", {"command": "help"}),
+    ("I paid 100 for lunch", None),
+])
+def test_parse_command_regex(text, expected):
+    from app.main import parse_command_regex
+    assert parse_command_regex(text) == expected
+
+@pytest.mark.asyncio
+async def test_send_telegram_message_retries_connect_errors():
+    """Test sends are retried when Telegram was never reached, but not after a response"""
+    from app.main import send_telegram_message
+    with patch('httpx.AsyncClient.post', side_effect=[
+        httpx.ConnectError("boom"),
+        mock_response(200, {"ok": True})
+    ]) as mock_post, patch('asyncio.sleep') as mock_sleep:
+        await send_telegram_message(TEST_CHAT_ID, "hi")
+    assert mock_post.call_count == 2
+    mock_sleep.assert_called_once()
+
+    with patch('httpx.AsyncClient.post', return_value=mock_response(400, {"ok": False})) as mock_post:
+        await send_telegram_message(TEST_CHAT_ID, "hi")
+    assert mock_post.call_count == 1
+
+@pytest.mark.asyncio
+async def test_bot_token_not_logged_by_httpx(caplog):
+    """Test request logging from httpx cannot leak the bot token in Telegram URLs"""
+    import logging
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, json={"ok": True}))
+    async with httpx.AsyncClient(base_url="https://api.telegram.org/bot123:SECRET", transport=transport) as tg:
+        with caplog.at_level(logging.INFO):
+            await tg.post("/sendMessage", json={"chat_id": TEST_CHAT_ID, "text": "hi"})
+    assert "SECRET" not in caplog.text
+
+@pytest.mark.asyncio
+async def test_send_telegram_message_flood_wait_releases_slot():
+    """Test a 429 backoff is capped and does not hold a send slot while sleeping"""
+    from app import main
+    slots_while_sleeping = []
+    async def fake_sleep(delay):
+        slots_while_sleeping.append(main.telegram_send_semaphore._value)
+    with patch('httpx.AsyncClient.post', side_effect=[
+        mock_response(429, {"ok": False, "parameters": {"retry_after": 60}}),
+        mock_response(200, {"ok": True})
+    ]), patch('asyncio.sleep', side_effect=fake_sleep) as mock_sleep:
+        await main.send_telegram_message(TEST_CHAT_ID, "hi")
+    mock_sleep.assert_called_once_with(main.TELEGRAM_MAX_RETRY_AFTER)
+    assert slots_while_sleeping == [100]
+
+def test_parse_expense_fast_path_equal_split():
+    from app.main import parse_expense_fast_path
+    parsed = parse_expense_fast_path("paid 100 for pizza with John, Alice and Bob")
+    assert parsed["amount"] == 100
+    assert parsed["payer"] == "me"
+    assert parsed["description"] == "pizza"
+    assert [p["name"] for p in parsed["participants"]] == ["me", "John", "Alice", "Bob"]
+    assert sum(p["share"] for p in parsed["participants"]) == 100
+
+@pytest.mark.parametrize("text", [
+    "paid 100 for lunch",
+    "paid 1000 for rent, John owes 600",
+    "paid 100 for pizza with everyone",
+    "paid 900 for dinner with John and Alice but Alice only had drinks",
+])
+def test_parse_expense_fast_path_defers_to_model(text):
+    from app.main import parse_expense_fast_path
+    assert parse_expense_fast_path(text) is None
+
+@pytest.mark.parametrize("text", [
+    "paid 300 for dinner with Bishal and John",
+    "paid 300 for dinner with bishal and John",
+    "paid 300 for dinner with Jena and John",
+    "paid 300 for dinner with myself and John",
+    "paid 300 for dinner with me and John",
+    "paid 300 for dinner with John and John",
+    "paid 300 for dinner with John, Alice and john",
+])
+def test_parse_expense_fast_path_defers_self_and_repeated_names(text):
+    from app.main import parse_expense_fast_path
+    assert parse_expense_fast_path(text, "Bishal", "Bishal Jena") is None
+
+@pytest.mark.asyncio
+async def test_concurrent_friend_fetches_share_one_call(mock_splitwise_friends):
+    import asyncio
+    from app.main import get_splitwise_friends
+    async def slow_get(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        return mock_response(200, mock_splitwise_friends)
+    with patch('httpx.AsyncClient.get', side_effect=slow_get) as mock_get:
+        results = await asyncio.gather(*(get_splitwise_friends(TEST_TOKEN) for _ in range(5)))
+    assert mock_get.call_count == 1
+    assert all(r == mock_splitwise_friends["friends"] for r in results)
+
+def test_friend_name_index_keeps_list_order_over_exact_match():
+    """Test an earlier friend containing the name beats a later exact match, as the linear scan did"""
+    from app.main import FriendNameIndex, match_name_to_user_id
+    friends = [{"id": 1, "first_name": "Johnny"}, {"id": 2, "first_name": "John"}]
+    assert match_name_to_user_id("john", friends) == 1
+    assert match_name_to_user_id("john", friends, name_index=FriendNameIndex(friends)) == 1
+
+def test_friend_name_index_reused_until_list_changes():
+    from app.main import friend_name_index
+    friends = [{"id": 111, "first_name": "John", "last_name": "Doe"}]
+    index = friend_name_index(TEST_TOKEN, friends)
+    assert index.lookup("doe") == 111
+    assert friend_name_index(TEST_TOKEN, friends) is index
+    assert friend_name_index(TEST_TOKEN, list(friends)) is not index
+
 def valid_token():
     return {
         "access_token": "test_token",
@@ -453,6 +696,21 @@ def test_search_query_returns_results():
                 found = any("pizza" in call[0][1] for call in mock_send.call_args_list)
                 assert found
 
+@pytest.mark.asyncio
+async def test_search_history_cached_until_expense_stored():
+    from app.main import search_history, store_memory
+    with patch('app.main.supermemory_client.search.execute') as mock_search, \
+         patch('app.main.supermemory_client.memories.add'):
+        mock_search.return_value.results = []
+        await search_history(TEST_CHAT_ID, "dinner last week")
+        await search_history(TEST_CHAT_ID, "Dinner  last week")
+        await store_memory(TEST_CHAT_ID, "hello", {"type": "chat_message"})
+        await search_history(TEST_CHAT_ID, "dinner last week")
+        assert mock_search.call_count == 1
+        await store_memory(TEST_CHAT_ID, "paid 100", {"type": "expense"})
+        await search_history(TEST_CHAT_ID, "dinner last week")
+        assert mock_search.call_count == 2
+
 def test_invalid_expense_format(mock_token_storage, mock_splitwise_friends):
     with patch('app.main.get_splitwise_friends', return_value=mock_splitwise_friends["friends"]):
         with patch('app.main.send_telegram_message') as mock_send:
@@ -513,9 +771,13 @@ def test_expense_with_unknown_friend(mock_token_storage, mock_splitwise_friends)
                         "text": "Charlie"
                     }
                 }
+                from app import main
+                main.friends_cache[TEST_TOKEN] = friends_initial
                 response2 = client.post("/telegram/webhook", json=webhook_data2)
                 assert response2.status_code == 200
                 mock_create.assert_called()
+                # The new friend makes the cached list stale
+                assert TEST_TOKEN not in main.friends_cache
 
 @pytest.mark.asyncio
 async def test_expense_api_endpoint(mock_token_storage):
@@ -531,6 +793,44 @@ async def test_expense_api_endpoint(mock_token_storage):
         assert response.status_code == 200
         assert response.json() == {"success": True}
 
+@pytest.mark.asyncio
+async def test_create_expense_payload(mock_token_storage):
+    """Test the Splitwise form payload, including the equal-split fallback"""
+    from app.main import create_splitwise_expense
+    expense = {
+        "cost": 100,
+        "description": "Dinner",
+        "currency_code": "INR",
+        "paid_by": TEST_SPLITWISE_ID,
+        "owed_by": [TEST_SPLITWISE_ID, 67890, 67891],
+        "shares": {"67890": 50}
+    }
+    with patch('httpx.AsyncClient.post', return_value=mock_response(200, {"expenses": []})) as mock_post:
+        await create_splitwise_expense(TEST_CHAT_ID, expense)
+    data = mock_post.call_args.kwargs["data"]
+    assert data["users__0__user_id"] == TEST_SPLITWISE_ID
+    assert data["users__0__paid_share"] == "100.00"
+    assert data["users__1__paid_share"] == "0.00"
+    assert data["users__0__owed_share"] == "33.33"
+    assert data["users__1__owed_share"] == "50.00"
+    # The last participant absorbs the difference to the total
+    assert data["users__2__owed_share"] == "16.67"
+    assert sum(float(data[f"users__{i}__owed_share"]) for i in range(3)) == pytest.approx(100)
+
+@pytest.mark.asyncio
+async def test_create_expense_equal_split_sums_to_cost(mock_token_storage):
+    from app.main import create_splitwise_expense
+    expense = {
+        "cost": 100,
+        "description": "Dinner",
+        "paid_by": TEST_SPLITWISE_ID,
+        "owed_by": [TEST_SPLITWISE_ID, 67890, 67891]
+    }
+    with patch('httpx.AsyncClient.post', return_value=mock_response(200, {"expenses": []})) as mock_post:
+        await create_splitwise_expense(TEST_CHAT_ID, expense)
+    data = mock_post.call_args.kwargs["data"]
+    assert [data[f"users__{i}__owed_share"] for i in range(3)] == ["33.33", "33.33", "33.34"]
+
 @pytest.mark.asyncio
 async def test_parse_api_endpoint(mock_token_storage, mock_splitwise_friends):
     """Test expense parsing API endpoint"""
@@ -1,2 +1,2 @@
 #!/bin/bash
-uvicorn app.main:app --host 0.0.0.0 --port 8000
+uvicorn app.main:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools --workers ${WEB_CONCURRENCY:-1} --limit-concurrency 1000 --timeout-keep-alive 30